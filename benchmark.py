@@ -0,0 +1,313 @@
+# -*- coding: utf-8-*-
+"""
+    Offline benchmark for the Domoticz plugin for Jasper
+
+    Starts a local stand-in for the Domoticz JSON API serving a synthetic
+    installation of configurable size and latency, drives `handle()` with
+    a corpus of utterances and a fake mic, and reports the throughput and
+    latency percentiles per installation size.
+
+    Usage:
+    python benchmark.py --devices 10 100 1000 5000 --latency 0.005
+"""
+import sys
+import json
+import logging
+import time
+import random
+import urlparse
+import argparse
+import threading
+import SocketServer
+import BaseHTTPServer
+
+import domoticz
+
+ROOMS = ["kitchen", "hallway", "bedroom", "bathroom", "garage", "attic",
+         "study", "nursery", "porch", "cellar"]
+FIXTURES = ["ceiling", "wall", "desk", "floor", "spot", "strip", "reading",
+            "pendant", "table", "corner"]
+SCENES = ["movie", "dinner", "party", "night", "morning", "away", "reading",
+          "cleaning"]
+
+class Installation(object):
+    """
+        Synthetic Domoticz installation with `size` devices, of which one
+        in ten is a thermostat with a setpoint on the same hardware and the
+        rest are lights, spread over the rooms. The time every device and
+        scene last changed is kept to answer `lastupdate` requests.
+    """
+    def __init__(self, size, seed=0):
+        rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.updated = {}
+        self.lights, self.temps, self.setpoints = [], [], []
+        self.plans = [{'idx': str(i + 1), 'Name': room.title()} for i, room in enumerate(ROOMS)]
+        self.plan_devices = dict((plan['idx'], []) for plan in self.plans)
+        for i in range(size):
+            idx = str(i + 1)
+            room = ROOMS[i % len(ROOMS)]
+            if i % 10 == 9:
+                hardware = 'Thermostat %s' % idx
+                device = {'idx': idx, 'Name': '%s thermostat %s' % (room.title(), idx),
+                          'Type': 'Temp + Humidity', 'HardwareName': hardware,
+                          'Temp': round(rng.uniform(15, 23), 1),
+                          'Humidity': rng.randint(30, 70), 'LastUpdate': ''}
+                self.temps.append(device)
+                self.setpoints.append({'idx': str(size + i + 1),
+                                       'Name': '%s setpoint %s' % (room.title(), idx),
+                                       'Type': 'Thermostat', 'HardwareName': hardware,
+                                       'SetPoint': '%.1f' % rng.uniform(17, 21), 'LastUpdate': ''})
+            else:
+                fixture = FIXTURES[(i // len(ROOMS)) % len(FIXTURES)]
+                device = {'idx': idx, 'Name': '%s %s %s' % (room.title(), fixture, idx),
+                          'Type': 'Light/Switch', 'SwitchType': 'On/Off',
+                          'HardwareName': 'Z-Wave', 'Status': rng.choice(['On', 'Off']),
+                          'Data': 'Off', 'Image': 'Light', 'LastUpdate': ''}
+                self.lights.append(device)
+            self.plan_devices[str(i % len(ROOMS) + 1)].append(
+                {'idx': idx, 'devidx': idx, 'type': 0, 'Name': device['Name']})
+        self.scenes = [{'idx': str(i + 1), 'Name': name.title(),
+                        'Type': 'Scene' if i % 2 else 'Group', 'Status': 'Off', 'LastUpdate': ''}
+                       for i, name in enumerate(SCENES)]
+
+    def devices(self, filter):
+        if filter == 'light':
+            return self.lights
+        if filter == 'temp':
+            return self.temps
+        if filter == 'utility':
+            return self.setpoints
+        return self.lights + self.temps + self.setpoints
+
+    def command(self, query):
+        """
+            Applies a `type=command` request
+
+            Returns:
+            The `result` of the command, or None
+        """
+        param = query.get('param')
+        with self.lock:
+            if param == 'getplandevices':
+                return self.plan_devices.get(query.get('idx'), [])
+            if param == 'switchlight':
+                for light in self.lights:
+                    if light['idx'] == query['idx']:
+                        status = query['switchcmd']
+                        if status == 'Toggle':
+                            status = 'Off' if light['Status'] == 'On' else 'On'
+                        light['Status'] = status
+                        self.updated[('device', light['idx'])] = time.time()
+            elif param == 'switchscene':
+                for scene in self.scenes:
+                    if scene['idx'] == query['idx']:
+                        scene['Status'] = query['switchcmd']
+                        self.updated[('scene', scene['idx'])] = time.time()
+            elif param == 'setsetpoint':
+                for setpoint in self.setpoints:
+                    if setpoint['idx'] == query['idx']:
+                        setpoint['SetPoint'] = query['setpoint']
+                        self.updated[('device', setpoint['idx'])] = time.time()
+
+    def changed(self, kind, entities, query):
+        """
+            Returns:
+            The entities of a kind, `device` or `scene`, changed since
+            the `lastupdate` of a request, or all entities without one
+        """
+        if 'lastupdate' not in query:
+            return entities
+        since = int(query['lastupdate'])
+        with self.lock:
+            return [entity for entity in entities if self.updated.get((kind, entity['idx']), 0) >= since]
+
+    def respond(self, query):
+        """
+            Returns:
+            The json response to a `/json.htm` request
+        """
+        type = query.get('type')
+        result = None
+        if type == 'devices':
+            result = self.changed('device', self.devices(query.get('filter', 'all')), query)
+            if 'rid' in query:
+                result = [device for device in self.devices('all') if device['idx'] == query['rid']]
+        elif type == 'scenes':
+            result = self.changed('scene', self.scenes, query)
+        elif type == 'plans':
+            result = self.plans
+        elif type == 'command':
+            result = self.command(query)
+        response = {'status': 'OK', 'title': type, 'ActTime': int(time.time())}
+        if result is not None:
+            response['result'] = result
+        return json.dumps(response)
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+        Serves the json API of `server.installation`, delaying every
+        response by `server.latency` seconds
+    """
+    protocol_version = 'HTTP/1.1'
+    # Buffer the response so it goes out in one write per request
+    wbufsize = -1
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        time.sleep(self.server.latency)
+        if url.path != '/json.htm':
+            self.send_error(404)
+            return
+        body = self.server.installation.respond(query)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json;charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_server(installation, latency):
+    """
+        Starts the stand-in Domoticz server on a free local port
+
+        Returns:
+        The server, which is stopped with `shutdown()`
+    """
+    server = Server(('127.0.0.1', 0), Handler)
+    server.installation = installation
+    server.latency = latency
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+class Mic(object):
+    """
+        Stand-in for the Jasper mic that keeps what was said
+    """
+    def __init__(self):
+        self.said = []
+
+    def say(self, phrase):
+        self.said.append(phrase)
+
+def utterances(installation, count, seed=0):
+    """
+        Builds a corpus of light, scene, room and thermostat commands for
+        the entities of an installation
+
+        Returns:
+        List of `count` utterances
+    """
+    rng = random.Random(seed)
+    templates = [
+        lambda: 'Turn %s the %s light' % (rng.choice(['on', 'off']), rng.choice(installation.lights)['Name']),
+        lambda: 'Toggle the %s light' % rng.choice(installation.lights)['Name'],
+        lambda: 'Activate the %s scene' % rng.choice(installation.scenes)['Name'],
+        lambda: 'Turn %s the %s group' % (rng.choice(['on', 'off']), rng.choice(installation.scenes)['Name']),
+        lambda: 'Turn off all lights in the %s room' % rng.choice(ROOMS),
+        lambda: 'What is the temperature in the %s' % rng.choice(installation.temps)['Name'],
+        lambda: 'Increase the temperature',
+    ]
+    if not installation.temps:
+        templates = templates[:5]
+    return [rng.choice(templates)() for _ in range(count)]
+
+def percentile(durations, p):
+    durations = sorted(durations)
+    return durations[max(int(round(p / 100.0 * len(durations) + 0.5)) - 1, 0)]
+
+def run(size, latency, iterations, settings):
+    """
+        Benchmarks `handle()` against a stand-in server for an installation
+        of `size` devices
+
+        Arguments:
+        size -- number of devices
+        latency -- seconds the server delays every response
+        iterations -- number of utterances to handle
+        settings -- additional `domoticz` profile settings
+
+        Returns:
+        Dictionary with the results in milliseconds
+    """
+    installation = Installation(size)
+    server = start_server(installation, latency)
+    profile = {'domoticz': dict(settings, server='http://127.0.0.1:%s' % server.server_port,
+                                username='benchmark', password='benchmark')}
+    mic = Mic()
+    corpus = utterances(installation, iterations)
+    domoticz.timings.reset()
+    try:
+        start = time.time()
+        client = domoticz.get_client(profile)
+        client.registry.ensure_fresh()
+        cold_start = time.time() - start
+        durations = []
+        start = time.time()
+        for text in corpus:
+            t = time.time()
+            domoticz.handle(text, mic, profile)
+            durations.append(time.time() - t)
+        elapsed = time.time() - start
+        if client.worker:
+            client.worker.join()
+        # Let the confirmations of the last commands finish
+        time.sleep(domoticz.CONFIRM_DELAY + latency + 0.5)
+    finally:
+        domoticz.get_client(profile).close()
+        server.shutdown()
+        server.server_close()
+    return {'devices': size, 'latency': latency * 1000, 'iterations': iterations,
+            'cold_start': round(1000 * cold_start, 3),
+            'throughput': round(iterations / elapsed, 1),
+            'p50': round(1000 * percentile(durations, 50), 3),
+            'p95': round(1000 * percentile(durations, 95), 3),
+            'p99': round(1000 * percentile(durations, 99), 3),
+            'max': round(1000 * max(durations), 3),
+            'stages': domoticz.timings.summary()}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the Domoticz plugin against a local stand-in server')
+    parser.add_argument('--devices', type=int, nargs='+', default=[10, 100, 1000, 5000],
+                        help='installation sizes to benchmark')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds the server delays every response')
+    parser.add_argument('--iterations', type=int, default=200,
+                        help='number of utterances per installation size')
+    parser.add_argument('--ttl', type=float, default=domoticz.DEFAULT_TTL,
+                        help='registry ttl in seconds')
+    parser.add_argument('--async', dest='async_mode', action='store_true',
+                        help='send commands in the background')
+    parser.add_argument('--output', help='write the results as json to this file')
+    parser.add_argument('--max-p95', type=float,
+                        help='exit with an error if the p95 latency in milliseconds exceeds this')
+    args = parser.parse_args(argv)
+    logging.basicConfig()
+
+    settings = {'ttl': args.ttl, 'async': args.async_mode}
+    results = []
+    print '%8s %10s %10s %10s %10s %10s %12s' % ('devices', 'cold ms', 'cmd/s', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms')
+    for size in args.devices:
+        result = run(size, args.latency, args.iterations, settings)
+        results.append(result)
+        print '%8s %10s %10s %10s %10s %10s %12s' % (size, result['cold_start'], result['throughput'],
+                                                     result['p50'], result['p95'], result['p99'], result['max'])
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.max_p95 is not None and any(result['p95'] > args.max_p95 for result in results):
+        print 'p95 latency exceeds %s ms' % args.max_p95
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,10 +5,36 @@
     Based on script v1.6.2 by Chopper_Rob:
     https://www.chopperrob.nl/domoticz/5-report-devices-online-status-to-domoticz
 """
+import os
 import re
+import sys
+import urllib
 import urllib2
+import urlparse
+import httplib
+import socket
 import json
 import base64
+import logging
+import logging.handlers
+import threading
+import time
+import math
+import random
+import contextlib
+import collections
+import Queue
+
+try:
+    import paho.mqtt.client as mqtt
+except ImportError:
+    mqtt = None
+
+try:
+    import yaml
+    from client import jasperpath
+except ImportError:
+    yaml = jasperpath = None
 
 __author__ = "Niels Looije"
 __license__ = "MIT"
@@ -19,105 +45,2202 @@ __status__ = "Development"
 
 DEBUG = False
 
-WORDS = [
-    "LIGHT", "LIGHTS",
-    "THERMOSTAT", "TEMPERATURE", "HUMIDITY", 
-    "SCENE", "GROUP", "ROOM", "MODE"
+# Default number of seconds before the cached registry is considered stale
+DEFAULT_TTL = 60
+
+# Default number of seconds between full reloads of the registry, in
+# between only devices and scenes changed since the last sync are fetched
+DEFAULT_FULL_SYNC = 3600
+
+# Seconds after a command before the devices changed since the last sync are
+# fetched to confirm the new states, and after which an unconfirmed state is
+# given up on
+CONFIRM_DELAY = 2
+PENDING_TIMEOUT = 30
+
+# Default maximum number of simultaneous connections per Domoticz server
+DEFAULT_POOL_SIZE = 4
+
+# Default number of seconds to wait for Domoticz to connect or respond
+DEFAULT_TIMEOUT = 5
+
+# Default number of times a failed read is retried, after a random delay of
+# up to RETRY_BACKOFF seconds that doubles with every retry
+DEFAULT_RETRIES = 2
+RETRY_BACKOFF = 0.25
+
+# Default number of consecutive failures after which Domoticz is considered
+# unreachable, and seconds after which it is probed again
+DEFAULT_BREAKER_THRESHOLD = 3
+DEFAULT_BREAKER_TIMEOUT = 30
+
+# Json requests, by type or command param, that only read and may be retried
+READ_REQUESTS = frozenset(['devices', 'scenes', 'plans', 'scenetimers',
+                           'command.getplandevices', 'command.getscenedevices',
+                           'command.getSunRiseSet', 'command.getversion'])
+
+# Errors of requests that failed
+REQUEST_ERRORS = (urllib2.HTTPError, socket.error, httplib.HTTPException)
+
+# Default maximum number of queued commands per worker thread in async mode
+DEFAULT_QUEUE_SIZE = 16
+
+# Default maximum number of audit events buffered in memory, the oldest
+# are dropped when Domoticz cannot keep up
+DEFAULT_AUDIT_SIZE = 256
+
+# Default number of buffered audit events, and seconds after the first of
+# them, after which they are flushed
+DEFAULT_AUDIT_BATCH = 16
+DEFAULT_AUDIT_INTERVAL = 5
+
+# Maximum length of a Domoticz log message of batched audit events
+AUDIT_MESSAGE_SIZE = 1024
+
+# Default maximum size in bytes of an audit file and number of rotated files
+DEFAULT_AUDIT_MAX_BYTES = 1048576
+DEFAULT_AUDIT_BACKUPS = 3
+
+# Default number of most recent timings kept per stage
+DEFAULT_TIMINGS_WINDOW = 500
+
+# Default MQTT topic on which Domoticz publishes device updates
+DEFAULT_MQTT_TOPIC = 'domoticz/out'
+
+# Device filters kept in the registry, as used by the handlers
+DEVICE_FILTERS = ['light', 'temp', 'utility']
+
+# Fields of the devices and scenes kept in the registry, all others are
+# dropped while the response is parsed
+RECORD_FIELDS = ('idx', 'Name', 'Status', 'Type', 'SetPoint', 'Temp',
+                 'Humidity', 'HardwareName')
+
+# Number of bytes read from a response at a time while it is parsed
+STREAM_CHUNK_SIZE = 16384
+
+# Format of the registry snapshot, snapshots of another version are ignored
+SNAPSHOT_VERSION = 1
+
+# Settings of scene devices and scene timers compared when provisioning, as
+# (name in the desired state, field of the Domoticz record, default)
+SCENE_DEVICE_FIELDS = (('device', 'DevID', None), ('command', 'Command', 'on'),
+                       ('level', 'Level', 100), ('hue', 'Hue', 0),
+                       ('ondelay', 'OnDelay', 0), ('offdelay', 'OffDelay', 0))
+SCENE_TIMER_FIELDS = (('type', 'Type', None), ('time', 'Time', None), ('date', 'Date', ''),
+                      ('days', 'Days', 128), ('command', 'Cmd', 'on'), ('level', 'Level', 100),
+                      ('randomness', 'Randomness', False), ('active', 'Active', True))
+
+# Values of the `command` of a scene timer
+TIMER_COMMANDS = {'on': 0, 'off': 1}
+
+logger = logging.getLogger(__name__)
+
+# Keywords that route a command to its handler, in order of precedence
+ROUTES = [
+    ('room', ['room']),
+    ('scene', ['scene', 'group', 'mode']),
+    ('light', ['light', 'lights']),
+    ('thermostat', ['thermostat', 'temperature', 'humidity']),
 ]
 
-def handle(text, mic, profile):
+# Routes of commands without keywords that name an entity, by the kinds
+# of entity, in order of precedence
+ENTITY_ROUTES = [
+    ('light', ['light']),
+    ('scene', ['scene']),
+    ('thermostat', ['temp', 'zone']),
+    ('room', ['plan']),
+]
+
+# Words of which one must be spoken with the name of an entity for the name
+# to route a command on its own, by route, so e.g. `who is at the front
+# door` is not taken for a light named `Front door`
+ENTITY_ACTIONS = {
+    'light': frozenset(['on', 'off', 'toggle']),
+    'scene': frozenset(['on', 'off', 'activate', 'deactivate']),
+    'thermostat': frozenset(['up', 'increase', 'down', 'decrease']),
+    'room': frozenset(['on', 'off', 'toggle']),
+}
+
+# Default minimum similarity, between 0 and 1, of a misrecognized name to
+# the name of an entity, and the margin within which the best matches are
+# reported as ambiguous
+DEFAULT_FUZZY_THRESHOLD = 0.7
+FUZZY_MARGIN = 0.1
+
+# Maximum number of words of an utterance compared to a name as a whole
+FUZZY_WINDOW = 4
+
+# Words of entity names that do not identify an entity on their own
+COMMON_WORDS = frozenset(['a', 'an', 'the', 'in', 'on', 'off', 'of', 'and',
+                          'to', 'all', 'is', 'my', 'turn', 'switch', 'toggle'])
+
+# Words of a location that mean the whole installation, e.g. `all lights in
+# the house`, rather than a room
+EVERYWHERE = frozenset(['house', 'home', 'building'])
+
+WORDS = [word.upper() for route, words in ROUTES for word in words]
+
+def get_credentials(profile):
+    """
+        Get the server, username and password from profile
+
+        Arguments:
+        profile -- contains the Domoticz server address, username and password
+
+        Returns:
+        Server url and encoded credentials for Domoticz server
+    """
+    server = profile['domoticz']['server']
+    username = profile['domoticz']['username']
+    password =  profile['domoticz']['password']
+    encoded_creds = encode_credentials(username, password)
+    return server, encoded_creds
+
+def encode_credentials(username, password):
+    """
+        Encode the credentials into a base64 encoded string
+
+        Arguments:
+        username -- a username for the Domoticz server
+        password -- a password corresponding to the username
+
+        Returns:
+        Encoded string of credentials
+    """
+    return base64.encodestring('%s:%s' % (username, password)).replace('\n', '')
+
+class ConnectionPool(object):
+    """
+        Bounded pool of keep-alive HTTP(S) connections to a Domoticz server.
+        Idle connections are reused most-recently-used first, so consecutive
+        requests from one handler go over the same socket, and at most
+        `size` requests are in flight at the same time.
+    """
+    def __init__(self, server, encoded_creds, size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT):
+        parsed = urlparse.urlparse(server)
+        if parsed.scheme == 'https':
+            self.connection_class = httplib.HTTPSConnection
+        else:
+            self.connection_class = httplib.HTTPConnection
+        self.server = server
+        self.netloc = parsed.netloc
+        self.timeout = timeout
+        self.prefix = parsed.path.rstrip('/')
+        self.headers = {"Authorization": "Basic %s" % encoded_creds,
+                        "Connection": "keep-alive"}
+        self.idle = Queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+
+    def request(self, url):
+        """
+            Sends a GET request over a pooled connection
+
+            Arguments:
+            url -- path and query relative to the server url
+
+            Returns:
+            Body of the response
+        """
+        with self.open(url) as response:
+            return response.read()
+
+    @contextlib.contextmanager
+    def open(self, url):
+        """
+            Sends a GET request over a pooled connection and holds on to
+            the connection while the response is read. The connection is
+            only reused if the response was read completely.
+
+            Arguments:
+            url -- path and query relative to the server url
+
+            Returns:
+            Context manager yielding the response
+        """
+        with self.slots:
+            try:
+                connection, reused = self.idle.get_nowait(), True
+            except Queue.Empty:
+                connection, reused = self.connection_class(self.netloc, timeout=self.timeout), False
+            try:
+                response = self._send(connection, url)
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                if not reused:
+                    raise
+                # The server closed the idle connection, retry on a fresh one
+                connection = self.connection_class(self.netloc, timeout=self.timeout)
+                try:
+                    response = self._send(connection, url)
+                except (httplib.HTTPException, socket.error):
+                    connection.close()
+                    raise
+            try:
+                if response.status != httplib.OK:
+                    response.read()
+                    raise urllib2.HTTPError(self.server + url, response.status,
+                                            response.reason, response.msg, None)
+                yield response
+            finally:
+                if response.isclosed() and not response.will_close:
+                    self.idle.put(connection)
+                else:
+                    connection.close()
+
+    def _send(self, connection, url):
+        connection.request('GET', self.prefix + url, headers=self.headers)
+        return connection.getresponse()
+
+    def close(self):
+        """
+            Closes all idle connections
+        """
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except Queue.Empty:
+                return
+
+class Timings(object):
+    """
+        Rolling record of the durations of the stages of handling a command,
+        e.g. `route`, `lookup`, `request:devices` and `decode`, keeping the
+        last `size` durations per stage to report percentiles.
+    """
+    def __init__(self, size=DEFAULT_TIMINGS_WINDOW):
+        self.size = size
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        """
+            Records the duration of a stage
+
+            Arguments:
+            stage -- name of the stage
+            seconds -- duration of the stage
+        """
+        with self.lock:
+            if stage not in self.samples:
+                self.samples[stage] = collections.deque(maxlen=self.size)
+            self.samples[stage].append(seconds)
+
+    @contextlib.contextmanager
+    def measure(self, stage):
+        """
+            Context manager recording the duration of its body as a stage
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(stage, time.time() - start)
+
+    def summary(self):
+        """
+            Returns:
+            Dictionary with per stage the number of recorded durations and
+            the p50, p95, p99 and maximum duration in milliseconds
+        """
+        with self.lock:
+            samples = dict((stage, sorted(durations)) for stage, durations in self.samples.items())
+        summary = {}
+        for stage, durations in samples.items():
+            def percentile(p):
+                rank = int(math.ceil(p / 100.0 * len(durations))) - 1
+                return round(1000 * durations[max(rank, 0)], 3)
+            summary[stage] = {'count': len(durations), 'p50': percentile(50),
+                              'p95': percentile(95), 'p99': percentile(99),
+                              'max': round(1000 * durations[-1], 3)}
+        return summary
+
+    def dump(self, path=None):
+        """
+            Writes the summary as json to a file, or to the log if no path
+            is given
+
+            Arguments:
+            path -- file to (over)write
+        """
+        data = json.dumps(self.summary(), sort_keys=True)
+        if path:
+            with open(path, 'w') as f:
+                f.write(data)
+        else:
+            logger.info('Domoticz timings: %s', data)
+
+    def reset(self):
+        with self.lock:
+            self.samples.clear()
+
+timings = Timings()
+
+def compile_routes(routes, offset=0):
+    """
+        Compiles routes into a vocabulary for constant time lookups
+
+        Arguments:
+        routes -- list of (route, words) in order of precedence
+        offset -- precedence of the first route
+
+        Returns:
+        Dictionary of (precedence, route) by word
+    """
+    return dict((word, (offset + rank, route))
+                for rank, (route, words) in enumerate(routes) for word in words)
+
+KEYWORDS = compile_routes(ROUTES)
+ENTITY_KINDS = compile_routes(ENTITY_ROUTES, len(ROUTES))
+
+def route(words, registries=()):
+    """
+        Routes a command by the keywords in `ROUTES` or, failing those, by
+        the whole names of entities in the registries spoken together with
+        one of the `ENTITY_ACTIONS` of their route. Both take a single pass
+        over the words.
+
+        Arguments:
+        words -- tokenized command
+        registries -- registries whose entity names are recognized
+
+        Returns:
+        Name of the route with the highest precedence, or None
+    """
+    best = None
+    for word in words:
+        match = KEYWORDS.get(word)
+        if match and (best is None or match < best):
+            best = match
+    if best:
+        return best[1]
+    spoken = set(words)
+    for registry in registries:
+        for kind in registry.named_kinds(words):
+            match = ENTITY_KINDS.get(kind)
+            if match and spoken & ENTITY_ACTIONS[match[1]] and (best is None or match < best):
+                best = match
+    return best[1] if best else None
+
+def request_label(type, arg):
+    """
+        Labels a json request by its type and, for commands, its param
+
+        Arguments:
+        type -- type of json request
+        arg -- additional settings for json request
+
+        Returns:
+        Label such as `devices` or `command.switchlight`
+    """
+    match = re.search(r'&param=([^&]*)', arg)
+    if type == 'command' and match:
+        return '%s.%s' % (type, match.group(1))
+    return type
+
+def is_idempotent(type, arg):
+    """
+        Returns:
+        True if the json request only reads and may be retried
+    """
+    return request_label(type, arg) in READ_REQUESTS
+
+def is_transient(error):
+    """
+        Returns:
+        True if a request failed on a timeout, a connection failure or
+        a server error, rather than on a response to the request itself
+    """
+    if isinstance(error, urllib2.HTTPError):
+        return error.code >= 500
+    return isinstance(error, (socket.error, httplib.HTTPException))
+
+class UnreachableError(RuntimeError):
+    """
+        Raised when Domoticz does not respond, or while the circuit
+        breaker is open after it failed to respond repeatedly
+    """
+
+class CircuitBreaker(object):
+    """
+        Fails requests fast after `threshold` consecutive failures. Once
+        `reset_timeout` seconds have passed one caller at a time is let
+        through to probe the server, and a successful probe closes the
+        breaker again.
+    """
+    def __init__(self, threshold=DEFAULT_BREAKER_THRESHOLD, reset_timeout=DEFAULT_BREAKER_TIMEOUT):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def is_open(self):
+        return self.opened is not None
+
+    def acquire_probe(self):
+        """
+            Returns:
+            True if the breaker is open, its reset timeout has passed and
+            the caller is to probe the server
+        """
+        with self.lock:
+            if self.opened is None or self.probing or time.time() - self.opened < self.reset_timeout:
+                return False
+            self.probing = True
+            return True
+
+    def succeeded(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+            self.probing = False
+
+    def failed(self):
+        with self.lock:
+            self.failures += 1
+            if self.probing or self.failures >= self.threshold:
+                if self.opened is None:
+                    logger.warning('Domoticz is unreachable, failing requests for %ss', self.reset_timeout)
+                self.opened = time.time()
+            self.probing = False
+
+def is_status_ok(obj):
+    """
+        Check if json object was properly retrieved
+
+        Arguments:
+        obj -- json object to check
+
+        Returns:
+        Boolean result of status check 
+    """
+    return isinstance(obj, dict) and obj.get('status') == 'OK'
+
+def iter_json_records(stream, fields=None, meta=None, chunk_size=STREAM_CHUNK_SIZE):
+    """
+        Incrementally parses a json response, yielding the records in its
+        `result` list one at a time while the response is read, so only
+        one record is held in memory and a caller can stop early
+
+        Arguments:
+        stream -- file-like object with the json response
+        fields -- names of the fields to keep of each record, or None
+        meta -- dictionary that receives the other fields of the response,
+                such as `status` and `ActTime`, once they are parsed
+
+        Returns:
+        Generator of record dictionaries
+    """
+    decoder = json.JSONDecoder()
+    whitespace = re.compile(r'\s*')
+    state = {'buffer': '', 'pos': 0, 'eof': False}
+    if meta is None:
+        meta = {}
+
+    def read():
+        if state['eof']:
+            return False
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            state['eof'] = True
+            return False
+        state['buffer'] = state['buffer'][state['pos']:] + chunk
+        state['pos'] = 0
+        return True
+
+    def peek():
+        while True:
+            state['pos'] = whitespace.match(state['buffer'], state['pos']).end()
+            if state['pos'] < len(state['buffer']):
+                return state['buffer'][state['pos']]
+            if not read():
+                raise ValueError('Unexpected end of json response')
+
+    def expect(chars):
+        char = peek()
+        if char not in chars:
+            raise ValueError('Expected %r in json response, found %r' % (chars, char))
+        state['pos'] += 1
+        return char
+
+    def decode():
+        # A value is only complete if it is followed by more input, as a
+        # number at the end of the buffer may continue in the next chunk
+        peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(state['buffer'], state['pos'])
+                if end < len(state['buffer']) or state['eof']:
+                    state['pos'] = end
+                    return value
+            except ValueError:
+                if state['eof']:
+                    raise
+            read()
+
+    expect('{')
+    if peek() == '}':
+        return
+    while True:
+        key = decode()
+        expect(':')
+        if key == 'result' and peek() == '[':
+            state['pos'] += 1
+            if peek() == ']':
+                state['pos'] += 1
+            else:
+                while True:
+                    record = decode()
+                    if fields is not None:
+                        record = dict((field, record[field]) for field in fields if field in record)
+                    yield record
+                    if expect(',]') == ']':
+                        break
+        else:
+            meta[key] = decode()
+        if expect(',}') == '}':
+            return
+
+class Entity(object):
+    """
+        Compact record of a device, scene, roomplan or zone that keeps only
+        the fields used by the module. Fields are accessed like the json
+        objects they are built from, e.g. `entity['Name']`, while `name`,
+        `type` and `state` hold the lowercased `Name`, `Type` and `Status`
+        so handlers do not normalize them on every command.
+    """
+    __slots__ = RECORD_FIELDS + ('SetPointIdx', 'Thermostat', 'name', 'type', 'state')
+
+    # Fields that are exposed as items, in order
+    FIELDS = RECORD_FIELDS + ('SetPointIdx', 'Thermostat')
+
+    def __init__(self, fields=(), **kwargs):
+        self.name = self.type = self.state = None
+        self.update(fields, **kwargs)
+
+    def __getitem__(self, field):
+        if field not in self.FIELDS:
+            raise KeyError(field)
+        try:
+            return getattr(self, field)
+        except AttributeError:
+            raise KeyError(field)
+
+    def __setitem__(self, field, value):
+        if field not in self.FIELDS:
+            raise KeyError(field)
+        setattr(self, field, value)
+        if field == 'Name':
+            self.name = value.lower()
+        elif field == 'Type':
+            self.type = value.lower()
+        elif field == 'Status':
+            self.state = value.lower()
+
+    def __contains__(self, field):
+        return field in self.FIELDS and hasattr(self, field)
+
+    def __repr__(self):
+        return 'Entity(%r)' % dict(self.items())
+
+    def get(self, field, default=None):
+        try:
+            return self[field]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return [field for field in self.FIELDS if hasattr(self, field)]
+
+    def items(self):
+        return [(field, getattr(self, field)) for field in self.keys()]
+
+    def update(self, fields=(), **kwargs):
+        """
+            Sets fields from a dictionary or json object and keyword
+            arguments, fields unknown to the record are ignored
+        """
+        if hasattr(fields, 'items'):
+            fields = fields.items()
+        for field, value in list(fields) + kwargs.items():
+            if field in self.FIELDS:
+                self[field] = value
+
+    def copy(self):
+        return Entity(self)
+
+class Registry(object):
+    """
+        Module-level cache of the devices, scenes, roomplans and roomplan
+        memberships of a Domoticz server. If `ttl` is positive a background
+        thread refreshes the cache every `ttl / 2` seconds, before it is
+        older than `ttl`, so the command path reads from memory and only
+        goes to Domoticz for the actual switch/setpoint commands. A command
+        that finds the cache stale is answered from it while the refresher
+        is woken; only a cache that was never loaded, or with a `ttl` of 0,
+        is refreshed on the command path. The lock guarding the cached
+        copies is never held while Domoticz is requested.
+
+        Between full reloads, which happen every `full_sync` seconds, only
+        the devices and scenes changed since the `ActTime` of the previous
+        sync are requested with the `lastupdate` parameter and merged in.
+        Removed devices and changes to roomplans are picked up by the next
+        full reload.
+
+        The names of all entities are kept in a `PhraseIndex` under the key
+        (kind, idx), where kind is a device filter, `scene` or `plan`. The
+        index is updated for the entities that changed on every refresh.
+
+        The members of every roomplan are kept in a two-way `MembershipIndex`
+        from roomplan to (kind, idx) keys and back, built from
+        `getplandevices` for all roomplans concurrently on a full reload.
+        A command that finds no device in a roomplan refreshes the members
+        of that roomplan with `refresh_room` before giving up.
+
+        Thermostats are joined with their setpoints once per refresh. The
+        `zones` in the profile name thermostats, e.g. `bedroom: {temp: 12,
+        setpoint: 34}`, and are indexed under the key (`zone`, name).
+
+        With a push `feed` connected, device updates are applied as they
+        are published and polling is suspended until the feed disconnects,
+        only the full reloads continue.
+
+        Devices, scenes and roomplans are kept as compact `Entity` records.
+        With a `snapshot` path they are saved after every change and loaded
+        on start, so commands are served from the snapshot while it is
+        revalidated in the background. Until then the loaded states are
+        not trusted, see `get_state`.
+
+        Successful commands are written through to the cached entities, so
+        the next command sees the new state without a request. Refreshed
+        copies that do not show the new state yet are overlaid with it
+        until they do or `PENDING_TIMEOUT` seconds have passed. The states
+        written through within `CONFIRM_DELAY` seconds of each other are
+        confirmed together by a single delta sync.
+    """
+    def __init__(self, client, ttl=DEFAULT_TTL, full_sync=DEFAULT_FULL_SYNC, zones={}, snapshot=None,
+                 fuzzy_threshold=DEFAULT_FUZZY_THRESHOLD):
+        self.client = client
+        self.snapshot = snapshot
+        self.fuzzy_threshold = fuzzy_threshold
+        self.ttl = ttl
+        self.full_sync = full_sync
+        self.devices = dict((filter, []) for filter in DEVICE_FILTERS)
+        self.scenes = []
+        self.plans = []
+        self.rooms = MembershipIndex()
+        self.unresolved = {}
+        self.thermostats = {}
+        self.zones = dict((name, dict((field, str(idx)) for field, idx in mapping.items()))
+                          for name, mapping in zones.items())
+        self.entities = {}
+        self.index = PhraseIndex()
+        self.pending = {}
+        self.feed = None
+        self.updated = None
+        self.synced = None
+        self.act_time = None
+        self.revalidated = False
+        self.dirty = False
+        self.lock = threading.RLock()
+        self.refreshing = threading.RLock()
+        self.wakeup = threading.Event()
+        self.refresher = None
+        self.confirmation = None
+
+    def refresh(self):
+        """
+            Brings the cached copies up to date, with a delta sync if the
+            last full reload is recent enough and a full reload otherwise
+        """
+        if self.act_time is None or time.time() - self.synced >= self.full_sync:
+            self.reload()
+            changed = True
+        else:
+            changed = self.sync()
+        self.revalidated = True
+        if self.snapshot and (changed or self.dirty):
+            self.save()
+
+    def reload(self):
+        """
+            Fetches devices, scenes, roomplans and then the memberships of
+            all roomplans from Domoticz, concurrently on at most `pool_size`
+            connections, and replaces the cached copies
+        """
+        def fetch_all(calls):
+            results = run_concurrently(calls, self.client.pool_size)
+            for result, error in results:
+                if error:
+                    raise error
+            return [result for result, error in results]
+
+        act_times = []
+        calls = [lambda filter=filter: self._fetch(act_times, 'devices', '&filter=%s&used=true&order=Name' % filter)
+                 for filter in DEVICE_FILTERS]
+        calls.append(lambda: self._fetch(act_times, 'scenes', ''))
+        calls.append(self.client.get_rooms)
+        results = fetch_all(calls)
+        devices = dict(zip(DEVICE_FILTERS, results))
+        scenes = results[len(DEVICE_FILTERS)]
+        plans = [Entity(plan) for plan in results[-1] or []]
+        rooms = fetch_all([lambda idx=plan['idx']: self.client.get_devices_in_room(idx) for plan in plans])
+        plan_devices = dict((plan['idx'], items or []) for plan, items in zip(plans, rooms))
+        with self.lock:
+            self._replace(devices, scenes, plans, plan_devices)
+            self.updated = self.synced = time.time()
+            self.act_time = min(act_times) if act_times else None
+        if DEBUG: print 'registry reloaded: %s' % ', '.join('%s %s' % (len(v), k) for k, v in devices.items())
+
+    def _replace(self, devices, scenes, plans, plan_devices):
+        """
+            Replaces the cached copies and rebuilds the indexes, with the
+            lock held
+
+            Arguments:
+            devices -- dictionary of device entities by filter
+            scenes -- list of scene entities
+            plans -- list of roomplan entities
+            plan_devices -- result of `getplandevices` by roomplan idx
+        """
+        self.devices = devices
+        self.scenes = scenes
+        self.plans = plans
+        entities = {}
+        for filter in DEVICE_FILTERS:
+            entities.update(((filter, device['idx']), device) for device in devices[filter])
+        entities.update((('scene', scene['idx']), scene) for scene in scenes)
+        entities.update((('plan', plan['idx']), plan) for plan in plans)
+        entities.update((('zone', name), Entity(idx=name, Name=name, Thermostat=zone['temp']))
+                        for name, zone in self.zones.items())
+        for key in set(self.entities) - set(entities):
+            self.index.discard(key)
+        self._index(entities)
+        self.entities = entities
+        self.unresolved = {}
+        for idx in set(self.rooms.members) - set(plan_devices):
+            self.rooms.discard(idx)
+        for idx, items in plan_devices.items():
+            self._link_room(idx, items)
+        self.thermostats = self._join_thermostats()
+
+    def sync(self):
+        """
+            Fetches only the devices and scenes changed since the previous
+            sync and merges them into the cached copies
+
+            Returns:
+            True if any device or scene changed
+        """
+        act_times = []
+        lastupdate = '&lastupdate=%s' % self.act_time
+        changed = {}
+        for filter in DEVICE_FILTERS:
+            changed[filter] = self._fetch(act_times, 'devices', '&filter=%s&used=true&order=Name%s' % (filter, lastupdate))
+        scenes = self._fetch(act_times, 'scenes', lastupdate)
+        with self.lock:
+            for filter in DEVICE_FILTERS:
+                self.devices[filter] = merge_by_idx(self.devices[filter], changed[filter])
+                self._index(dict(((filter, device['idx']), device) for device in changed[filter]))
+            self.scenes = merge_by_idx(self.scenes, scenes)
+            self._index(dict((('scene', scene['idx']), scene) for scene in scenes))
+            if changed['temp'] or changed['utility']:
+                self.thermostats = self._join_thermostats()
+            self.updated = time.time()
+            if act_times:
+                self.act_time = min(act_times)
+        if DEBUG: print 'registry synced: %s' % ', '.join('%s %s' % (len(v), k) for k, v in changed.items())
+        return bool(scenes) or any(changed.values())
+
+    def save(self):
+        """
+            Writes the devices, scenes, roomplans and roomplan memberships
+            to the `snapshot` file, replacing it atomically
+        """
+        def records(entities):
+            return [dict(entity.items()) for entity in entities]
+
+        with self.lock:
+            self.dirty = False
+            plan_devices = dict((idx, [{'devidx': devidx, 'type': 1 if kind == 'scene' else 0}
+                                       for kind, devidx in keys])
+                                for idx, keys in self.rooms.members.items())
+            for devidx, plans in self.unresolved.items():
+                for idx in plans:
+                    plan_devices.setdefault(idx, []).append({'devidx': devidx, 'type': 0})
+            snapshot = {'version': SNAPSHOT_VERSION, 'server': self.client.pool.server,
+                        'act_time': self.act_time, 'synced': self.synced,
+                        'devices': dict((filter, records(devices)) for filter, devices in self.devices.items()),
+                        'scenes': records(self.scenes), 'plans': records(self.plans),
+                        'plan_devices': plan_devices}
+        path = self.snapshot + '.tmp'
+        try:
+            with open(path, 'w') as f:
+                json.dump(snapshot, f, separators=(',', ':'))
+            os.rename(path, self.snapshot)
+        except (IOError, OSError):
+            logger.warning('Saving the Domoticz registry snapshot failed', exc_info=True)
+
+    def load(self):
+        """
+            Replaces the cached copies with the `snapshot` file, if it was
+            saved for the same server. The loaded registry is considered
+            fresh and its next sync fetches the changes since it was saved,
+            but its states are not trusted until that sync revalidates them.
+
+            Returns:
+            True if the snapshot was loaded
+        """
+        try:
+            with open(self.snapshot) as f:
+                snapshot = json.load(f)
+        except IOError:
+            return False
+        except ValueError:
+            logger.warning('Ignoring the invalid Domoticz registry snapshot %s', self.snapshot)
+            return False
+        if snapshot.get('version') != SNAPSHOT_VERSION or snapshot.get('server') != self.client.pool.server:
+            return False
+        devices = dict((filter, [Entity(device) for device in snapshot['devices'].get(filter, [])])
+                       for filter in DEVICE_FILTERS)
+        with self.lock:
+            self._replace(devices, [Entity(scene) for scene in snapshot['scenes']],
+                          [Entity(plan) for plan in snapshot['plans']], snapshot['plan_devices'])
+            self.updated = time.time()
+            self.synced = snapshot['synced']
+            self.act_time = snapshot['act_time']
+            self.revalidated = False
+        if DEBUG: print 'registry loaded from %s' % self.snapshot
+        return True
+
+    def _join_thermostats(self):
+        """
+            Joins the `temp` devices with the `utility` setpoints on
+            `HardwareName` through a hash index, in O(n+m). If a hardware
+            has several setpoints, the one sharing most words with the name
+            of the thermostat is used, unless a zone maps it explicitly.
+
+            Returns:
+            Dictionary of thermostats by idx, with `SetPoint` and
+            `SetPointIdx` added if a setpoint was found
+        """
+        setpoints, hardware = {}, {}
+        for device in self.devices['utility']:
+            if 'SetPoint' in device:
+                setpoints[device['idx']] = device
+                hardware.setdefault(device['HardwareName'], []).append(device)
+        explicit = dict((zone['temp'], setpoints.get(zone['setpoint']))
+                        for zone in self.zones.values() if 'setpoint' in zone)
+        thermostats = {}
+        for device in self.devices['temp']:
+            setpoint = explicit.get(device['idx'])
+            candidates = hardware.get(device['HardwareName'])
+            if setpoint is None and candidates:
+                words = set(tokenize(device['Name']))
+                setpoint = max(candidates, key=lambda candidate: len(words.intersection(tokenize(candidate['Name']))))
+            thermostat = device.copy()
+            if setpoint is not None:
+                thermostat['SetPoint'] = setpoint['SetPoint']
+                thermostat['SetPointIdx'] = setpoint['idx']
+            thermostats[device['idx']] = thermostat
+        return thermostats
+
+    def _index(self, entities):
+        for key, entity in entities.items():
+            self._reconcile(key, entity)
+            self.entities[key] = entity
+            self.index.add(key, entity['Name'])
+            if key[0] in DEVICE_FILTERS and key[1] in self.unresolved:
+                for idx in self.unresolved.pop(key[1]):
+                    self.rooms.add(idx, key)
+
+    def _link_room(self, idx, items):
+        """
+            Replaces the members of a roomplan in the room index. Devices
+            that are not in the registry yet are linked once they appear.
+
+            Arguments:
+            idx -- index of the roomplan
+            items -- result of `getplandevices` for the roomplan
+        """
+        keys = set()
+        for item in items:
+            devidx = item['devidx']
+            if item['type'] == 1:
+                keys.add(('scene', devidx))
+                continue
+            resolved = [(filter, devidx) for filter in DEVICE_FILTERS if (filter, devidx) in self.entities]
+            if resolved:
+                keys.update(resolved)
+            else:
+                self.unresolved.setdefault(devidx, set()).add(idx)
+        self.rooms.set(idx, keys)
+
+    def refresh_room(self, idx):
+        """
+            Fetches the members of a single roomplan and updates the index
+
+            Arguments:
+            idx -- index of the roomplan
+        """
+        items = self.client.get_devices_in_room(idx) or []
+        with self.lock:
+            for devidx, plans in self.unresolved.items():
+                plans.discard(idx)
+                if not plans:
+                    del self.unresolved[devidx]
+            self._link_room(idx, items)
+
+    def write_through(self, key, **fields):
+        """
+            Applies the result of a successful command to the cached entity
+            and, for devices, schedules a confirmation after `CONFIRM_DELAY`
+            unless one is scheduled already. The entity is saved to the
+            snapshot with the next refresh, even if that finds no changes.
+
+            Arguments:
+            key -- (kind, idx) of the commanded entity
+            fields -- new values of the entity, e.g. Status='On'
+        """
+        with self.lock:
+            entity = self.entities.get(key)
+            if entity is None:
+                return
+            entity.update(fields)
+            self.pending[key] = fields, time.time()
+            self.dirty = True
+            if 'SetPoint' in fields:
+                for thermostat in self.thermostats.values():
+                    if thermostat.get('SetPointIdx') == key[1]:
+                        thermostat['SetPoint'] = fields['SetPoint']
+            if key[0] in DEVICE_FILTERS and self.confirmation is None:
+                self.confirmation = threading.Timer(CONFIRM_DELAY, self.confirm)
+                self.confirmation.daemon = True
+                self.confirmation.start()
+
+    def confirm(self):
+        """
+            Refreshes the registry, usually with a delta sync of the devices
+            changed since the last one, to reconcile all states written
+            through since the confirmation was scheduled
+        """
+        with self.lock:
+            self.confirmation = None
+        try:
+            with self.refreshing:
+                self.refresh()
+        except Exception:
+            logger.warning('Confirming the state of the commanded devices failed', exc_info=True)
+
+    def restore(self, key):
+        """
+            Fetches a single device to reconcile its written through state
+
+            Arguments:
+            key -- (filter, idx) of the device
+        """
+        filter, idx = key
+        try:
+            devices = [Entity(device) for device in self.client.get_device(idx, RECORD_FIELDS)]
+        except Exception:
+            logger.warning('Restoring the state of device %s failed', idx, exc_info=True)
+            return
+        with self.lock:
+            self.devices[filter] = merge_by_idx(self.devices[filter], devices)
+            self._index(dict(((filter, device['idx']), device) for device in devices))
+            if filter in ['temp', 'utility']:
+                self.thermostats = self._join_thermostats()
+
+    def revert(self, key):
+        """
+            Gives up on the written through state of an entity after its
+            command failed and fetches devices to restore their state
+
+            Arguments:
+            key -- (kind, idx) of the commanded entity
+        """
+        with self.lock:
+            self.pending.pop(key, None)
+        if key[0] in DEVICE_FILTERS:
+            self.restore(key)
+
+    def _reconcile(self, key, entity):
+        """
+            Overlays a refreshed entity with its written through state,
+            unless it already shows that state or the state timed out
+        """
+        if key not in self.pending:
+            return
+        fields, written = self.pending[key]
+        if time.time() - written >= PENDING_TIMEOUT or \
+           all(entity.get(field) == value for field, value in fields.items()):
+            del self.pending[key]
+        else:
+            entity.update(fields)
+
+    def _fetch(self, act_times, type, arg):
+        records, meta = self.client.get_json_records(type, arg, RECORD_FIELDS)
+        records = [Entity(record) for record in records]
+        if 'ActTime' in meta:
+            act_times.append(meta['ActTime'])
+        return records
+
+    def is_stale(self):
+        """
+            Returns:
+            True if the registry was never loaded or is older than `ttl`,
+            or than `full_sync` while a push feed keeps it up to date
+        """
+        if self.updated is None:
+            return True
+        if self.is_pushed():
+            return time.time() - self.synced >= self.full_sync
+        return time.time() - self.updated >= self.ttl
+
+    def is_pushed(self):
+        """
+            Returns:
+            True if a push feed is connected
+        """
+        return self.feed is not None and self.feed.connected
+
+    def invalidate(self):
+        """
+            Marks the registry stale, e.g. after updates may have been missed
+        """
+        with self.lock:
+            self.updated = None
+
+    def apply_event(self, event):
+        """
+            Applies a device update published by Domoticz
+
+            Arguments:
+            event -- decoded `domoticz/out` message
+        """
+        idx = self.client.qualify(event['idx'])
+        fields = event_fields(event)
+        with self.lock:
+            for filter in DEVICE_FILTERS:
+                key = (filter, idx)
+                entity = self.entities.get(key)
+                if entity is None:
+                    continue
+                entity.update(fields)
+                self._reconcile(key, entity)
+                self.index.add(key, entity['Name'])
+                if filter == 'temp' and idx in self.thermostats:
+                    self.thermostats[idx].update(fields)
+                if 'SetPoint' in fields:
+                    for thermostat in self.thermostats.values():
+                        if thermostat.get('SetPointIdx') == idx:
+                            thermostat['SetPoint'] = entity['SetPoint']
+
+    def ensure_fresh(self):
+        """
+            Refreshes the registry if it is stale. A registry that was
+            loaded before is served as is while the background refresher
+            brings it up to date, unless `ttl` is 0. While Domoticz is
+            unreachable a registry that was loaded before is kept as is.
+        """
+        if not self.is_stale():
+            return
+        if self.synced is not None and self.refresher is not None:
+            self.wakeup.set()
+            return
+        with self.refreshing:
+            if not self.is_stale():
+                return
+            try:
+                self.refresh()
+            except UnreachableError:
+                if self.synced is None:
+                    raise
+                if DEBUG: print 'serving the registry from cache'
+
+    def start(self):
+        """
+            Loads the snapshot, if any, and starts the background refresher
+            if `ttl` is positive. A registry loaded from the snapshot is
+            revalidated straight away.
+        """
+        delay = self.ttl / 2.0
+        if self.snapshot and self.updated is None and self.load():
+            delay = 0
+        if self.ttl > 0 and self.refresher is None:
+            self.refresher = threading.Thread(target=self._refresh_loop, args=(delay,), name='domoticz-registry')
+            self.refresher.daemon = True
+            self.refresher.start()
+
+    def _refresh_loop(self, delay):
+        while True:
+            self.wakeup.wait(delay)
+            woken = self.wakeup.is_set()
+            self.wakeup.clear()
+            delay = self.ttl / 2.0
+            # A command may wake the refresher just after a refresh
+            if (woken or self.is_pushed()) and not self.is_stale():
+                continue
+            try:
+                with self.refreshing:
+                    self.refresh()
+            except Exception:
+                logger.warning('Refreshing the Domoticz registry failed', exc_info=True)
+
+    def get_devices(self, filter):
+        with self.lock:
+            return self.devices[filter]
+
+    def get_scenes(self):
+        with self.lock:
+            return self.scenes
+
+    def get_rooms(self):
+        with self.lock:
+            return self.plans
+
+    def get_room_members(self, idx):
+        """
+            Returns:
+            Set of (kind, idx) keys of the devices, scenes and groups in
+            the roomplan with index idx
+        """
+        with self.lock:
+            return self.rooms.members_of(idx)
+
+    def get_rooms_of(self, key):
+        """
+            Returns:
+            List of the roomplans the entity with key (kind, idx) is in
+        """
+        with self.lock:
+            return [self.entities[('plan', idx)] for idx in sorted(self.rooms.groups_of(key))
+                    if ('plan', idx) in self.entities]
+
+    def find(self, words, kinds, members=None):
+        """
+            Finds the entities named in an utterance
+
+            Arguments:
+            words -- tokenized utterance
+            kinds -- kinds of entities to look for, e.g. ['light']
+            members -- optional set of (kind, idx) keys to restrict the search to
+
+            Returns:
+            List of (phrase, [(key, entity), ...]) for every name in the
+            utterance in order of appearance, preferring the longest names.
+            If no name is found, the names most similar to a phrase of at
+            least `fuzzy_threshold` are. More than one entity for a phrase
+            means the name is ambiguous.
+        """
+        def accept(key):
+            return key[0] in kinds and (members is None or key in members)
+        with self.lock:
+            matches = self.index.match(words, accept)
+            if not matches:
+                matches = self.index.match_similar(words, self.fuzzy_threshold, accept)
+            return [(phrase, [(key, self.entities[key]) for key in keys])
+                    for phrase, keys in matches]
+
+    def named_kinds(self, words):
+        """
+            Returns:
+            The kinds of the entities whose whole name is in the words
+        """
+        with self.lock:
+            return set(key[0] for phrase, keys in self.index.match(words) for key in keys)
+
+    def get_thermostats(self):
+        with self.lock:
+            return [self.thermostats[device['idx']] for device in self.devices['temp']]
+
+    def get_thermostat(self, idx):
+        with self.lock:
+            return self.thermostats.get(idx)
+
+    def get(self, key):
+        """
+            Returns:
+            The entity with key (kind, idx), or None if it is unknown
+        """
+        with self.lock:
+            return self.entities.get(key)
+
+    def get_state(self, key):
+        """
+            Returns:
+            The lowercased status of the entity with key (kind, idx), or
+            None if it is unknown or was loaded from the snapshot and has
+            neither been revalidated nor written through since
+        """
+        with self.lock:
+            entity = self.entities.get(key)
+            if entity is None or not (self.revalidated or key in self.pending):
+                return None
+            return entity.state
+
+def ngrams(words, n=2):
+    """
+        Returns:
+        The set of character n-grams of words joined without spaces,
+        marking the start and end with `$`
+    """
+    text = '$%s$' % ''.join(words)
+    return frozenset(text[i:i + n] for i in range(max(len(text) - n + 1, 1)))
+
+def tokenize(text):
+    """
+        Splits text into lowercase words, ignoring punctuation
+
+        Arguments:
+        text -- user-input or name of an entity
+
+        Returns:
+        List of words
+    """
+    return re.findall(r'\w+', text.lower(), re.UNICODE)
+
+class PhraseIndex(object):
+    """
+        Word trie over the names of entities. A single pass over an
+        utterance finds the longest names it contains, in time proportional
+        to the length of the utterance times the length of the longest name.
+        Names are also indexed by their character bigrams to find names
+        similar to misrecognized ones.
+    """
+    def __init__(self):
+        self.root = {}
+        self.phrases = {}
+        self.grams = {}
+        self.postings = {}
+
+    def add(self, key, name):
+        """
+            Adds or renames an entity
+
+            Arguments:
+            key -- hashable key of the entity
+            name -- name of the entity, may contain several words
+        """
+        words = tuple(tokenize(name))
+        if self.phrases.get(key) == words:
+            return
+        self.discard(key)
+        if not words:
+            return
+        node = self.root
+        for word in words:
+            node = node.setdefault(word, {})
+        node.setdefault(None, set()).add(key)
+        self.phrases[key] = words
+        self.grams[key] = ngrams(words)
+        for gram in self.grams[key]:
+            self.postings.setdefault(gram, set()).add(key)
+
+    def discard(self, key):
+        """
+            Removes an entity if it is in the index
+
+            Arguments:
+            key -- key of the entity
+        """
+        words = self.phrases.pop(key, None)
+        if words is None:
+            return
+        path = [self.root]
+        for word in words:
+            path.append(path[-1][word])
+        path[-1][None].discard(key)
+        if not path[-1][None]:
+            del path[-1][None]
+        # Prune the branch up to the first node still in use
+        for i in reversed(range(len(words))):
+            if path[i + 1]:
+                break
+            del path[i][words[i]]
+        for gram in self.grams.pop(key):
+            self.postings[gram].discard(key)
+            if not self.postings[gram]:
+                del self.postings[gram]
+
+    def match_similar(self, words, threshold, accept=None):
+        """
+            Finds the names most similar to a phrase of up to `FUZZY_WINDOW`
+            words that does not start or end with a keyword or common word,
+            by the Dice coefficient of their bigrams. Only names sharing one
+            of the rarest bigrams of a phrase can reach the threshold, so
+            only those are compared.
+
+            Arguments:
+            words -- tokenized utterance
+            threshold -- minimum similarity between 0 and 1
+            accept -- optional predicate on keys to restrict the matches
+
+            Returns:
+            List with the phrase and the keys of the most similar names,
+            more than one if they are within `FUZZY_MARGIN` of the best, or
+            an empty list
+        """
+        scores = {}
+        def is_name_word(word):
+            return word not in KEYWORDS and word not in COMMON_WORDS
+
+        # Names just below the threshold still make the best one ambiguous
+        floor = max(threshold - FUZZY_MARGIN, 0)
+
+        for i in range(len(words)):
+            if not is_name_word(words[i]):
+                continue
+            for j in range(i + 1, min(len(words), i + FUZZY_WINDOW) + 1):
+                if not is_name_word(words[j - 1]):
+                    continue
+                grams = ngrams(words[i:j])
+                # A name reaches the threshold only if it shares at least
+                # `overlap` bigrams, so it shares one of the rarest others
+                overlap = int(math.ceil(floor * len(grams) / (2 - floor)))
+                rarest = sorted(grams, key=lambda gram: len(self.postings.get(gram, ())))
+                candidates = set()
+                for gram in rarest[:max(len(grams) - overlap + 1, 1)]:
+                    candidates.update(self.postings.get(gram, ()))
+                for key in candidates:
+                    if accept is not None and not accept(key):
+                        continue
+                    score = 2.0 * len(grams & self.grams[key]) / (len(grams) + len(self.grams[key]))
+                    if score >= floor and score > scores.get(key, (0,))[0]:
+                        scores[key] = score, ' '.join(words[i:j])
+        if not scores:
+            return []
+        best, phrase = max(scores.values())
+        if best < threshold:
+            return []
+        return [(phrase, sorted(key for key, (score, _) in scores.items() if score >= best - FUZZY_MARGIN))]
+
+    def match(self, words, accept=None):
+        """
+            Finds the names in a list of words. At every position the longest
+            name is taken, after which the search continues behind it.
+
+            Arguments:
+            words -- tokenized utterance
+            accept -- optional predicate on keys to restrict the matches
+
+            Returns:
+            List of (phrase, keys) in order of appearance
+        """
+        matches = []
+        i = 0
+        while i < len(words):
+            node, best = self.root, None
+            j = i
+            while j < len(words) and words[j] in node:
+                node = node[words[j]]
+                j += 1
+                keys = [key for key in node.get(None, ()) if accept is None or accept(key)]
+                if keys:
+                    best = j, keys
+            if best:
+                end, keys = best
+                matches.append((' '.join(words[i:end]), sorted(keys)))
+                i = end
+            else:
+                i += 1
+        return matches
+
+def event_fields(event):
+    """
+        Maps a device update published on `domoticz/out` onto the fields
+        of the json API used by the registry
+
+        Arguments:
+        event -- decoded `domoticz/out` message
+
+        Returns:
+        Dictionary with `Name` and, depending on the type of device,
+        `Status`, `Temp` and `Humidity` or `SetPoint`
+    """
+    fields = {}
+    if 'name' in event:
+        fields['Name'] = event['name']
+    dtype = event.get('dtype', '')
+    if 'switchType' in event:
+        fields['Status'] = 'Off' if event.get('nvalue') == 0 else 'On'
+    elif dtype.startswith('Temp') and 'svalue1' in event:
+        fields['Temp'] = float(event['svalue1'])
+        if 'Humidity' in dtype and 'svalue2' in event:
+            fields['Humidity'] = int(event['svalue2'])
+    elif dtype in ['Thermostat', 'Setpoint'] and 'svalue1' in event:
+        fields['SetPoint'] = event['svalue1']
+    return fields
+
+class MqttFeed(object):
+    """
+        Keeps a registry up to date with the device updates Domoticz
+        publishes over MQTT. The connection is kept up in the background
+        and the registry is refreshed after every reconnect to catch up
+        on missed updates. Requires the paho-mqtt package.
+    """
+    def __init__(self, registry, host, port=1883, topic=DEFAULT_MQTT_TOPIC,
+                 username=None, password=None):
+        if mqtt is None:
+            raise RuntimeError('The Domoticz mqtt feed requires the paho-mqtt package')
+        self.registry = registry
+        self.topic = topic
+        self.connected = False
+        self.client = mqtt.Client()
+        if username:
+            self.client.username_pw_set(username, password)
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.client.on_message = self._on_message
+        self.client.connect_async(host, port)
+
+    def start(self):
+        self.client.loop_start()
+
+    def stop(self):
+        self.client.disconnect()
+        self.client.loop_stop()
+
+    def _on_connect(self, client, userdata, flags, rc):
+        if rc != 0:
+            logger.warning('Connecting to the Domoticz mqtt broker failed: %s', mqtt.connack_string(rc))
+            return
+        client.subscribe(self.topic)
+        self.connected = True
+        self.registry.invalidate()
+
+    def _on_disconnect(self, client, userdata, rc):
+        self.connected = False
+
+    def _on_message(self, client, userdata, message):
+        try:
+            event = json.loads(message.payload)
+            self.registry.apply_event(event)
+        except (ValueError, KeyError, TypeError):
+            logger.warning('Ignoring invalid Domoticz mqtt message %r', message.payload, exc_info=True)
+
+class MembershipIndex(object):
+    """
+        Two-way index between groups, such as roomplans, and the keys of
+        their members, so both the members of a group and the groups of a
+        member are found without a request.
+    """
+    def __init__(self):
+        self.members = {}
+        self.groups = {}
+
+    def set(self, group, keys):
+        """
+            Replaces the members of a group, only updating the links that
+            changed
+
+            Arguments:
+            group -- index of the group
+            keys -- keys of the members
+        """
+        old = self.members.get(group, set())
+        keys = set(keys)
+        for key in old - keys:
+            self._unlink(group, key)
+        for key in keys - old:
+            self.add(group, key)
+        self.members.setdefault(group, set())
+
+    def add(self, group, key):
+        self.members.setdefault(group, set()).add(key)
+        self.groups.setdefault(key, set()).add(group)
+
+    def discard(self, group):
+        """
+            Removes a group and its links
+        """
+        for key in self.members.get(group, set()).copy():
+            self._unlink(group, key)
+        self.members.pop(group, None)
+
+    def _unlink(self, group, key):
+        self.members[group].discard(key)
+        self.groups[key].discard(group)
+        if not self.groups[key]:
+            del self.groups[key]
+
+    def members_of(self, group):
+        return frozenset(self.members.get(group, ()))
+
+    def groups_of(self, key):
+        return frozenset(self.groups.get(key, ()))
+
+class SingleFlight(object):
+    """
+        Coalesces concurrent calls with the same key: the first caller runs
+        the call and the others wait for it and share its result or error.
+        The shared result must not be modified by the callers.
+    """
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, function):
+        """
+            Runs a function, unless a call with the same key is in flight
+
+            Arguments:
+            key -- hashable key of the call
+            function -- function without arguments to run
+
+            Returns:
+            The result of the function or of the call in flight
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            if call is None:
+                call = self.calls[key] = {'done': threading.Event()}
+                leader = True
+            else:
+                leader = False
+        if not leader:
+            call['done'].wait()
+            if 'error' in call:
+                error = call['error']
+                raise error[0], error[1], error[2]
+            return call['result']
+        try:
+            call['result'] = function()
+            return call['result']
+        except BaseException:
+            call['error'] = sys.exc_info()
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call['done'].set()
+
+def run_concurrently(calls, workers):
+    """
+        Runs calls on a bounded number of threads and waits for all of them
+
+        Arguments:
+        calls -- list of functions without arguments
+        workers -- maximum number of threads
+
+        Returns:
+        List of (result, exception) in the order of calls, where
+        exception is None if the call succeeded
+    """
+    results = [None] * len(calls)
+    pending = Queue.Queue()
+    for i, call in enumerate(calls):
+        pending.put((i, call))
+
+    def work():
+        while True:
+            try:
+                i, call = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[i] = call(), None
+            except Exception as e:
+                results[i] = None, e
+
+    threads = [threading.Thread(target=work) for _ in range(min(workers, len(calls)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+def merge_by_idx(entities, changed):
+    """
+        Merges changed entities into a list of entities
+
+        Arguments:
+        entities -- list of json objects with an `idx` field
+        changed -- updated or added json objects
+
+        Returns:
+        New list in which entities with a matching `idx` are replaced
+        and unknown entities are appended
+    """
+    if not changed:
+        return entities
+    merged = list(entities)
+    positions = dict((entity['idx'], i) for i, entity in enumerate(merged))
+    for entity in changed:
+        if entity['idx'] in positions:
+            merged[positions[entity['idx']]] = entity
+        else:
+            positions[entity['idx']] = len(merged)
+            merged.append(entity)
+    return merged
+
+def quote_arg(value):
     """
-        Responds to user-input, typically speech text, with the result of
-        a command given by the user to control devices, scenes and/or groups
-        in different rooms through the Domoticz JSON API.
+        Returns:
+        The value, e.g. a name or message, quoted for a json url
+    """
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return urllib.quote(str(value))
+
+def normalize_command(command):
+    """
+        Returns:
+        The command of a scene device or timer as `on` or `off`, also
+        when yaml decoded it as a boolean
+    """
+    if isinstance(command, bool):
+        return 'on' if command else 'off'
+    return str(command).lower()
+
+def normalize_device(device):
+    """
+        Returns:
+        A copy of a desired scene device with its `command` as `on` or `off`
+    """
+    device = dict(device)
+    device['command'] = normalize_command(device.get('command', 'on'))
+    return device
+
+def normalize_timer(timer):
+    """
+        Returns:
+        A copy of a desired scene timer with its `command` as the number
+        Domoticz uses and its `time` as HH:MM
+    """
+    timer = dict(timer)
+    command = normalize_command(timer.get('command', 'on'))
+    timer['command'] = TIMER_COMMANDS.get(command, command)
+    hour, minute = str(timer['time']).split(':')
+    timer['time'] = '%02d:%02d' % (int(hour), int(minute))
+    return timer
+
+def check_state(state):
+    """
+        Raises a RuntimeError if a desired state for provision() lacks a
+        required setting
+    """
+    for scene in state.get('scenes', []):
+        if not scene.get('name'):
+            raise RuntimeError('Scene without name in desired state')
+        for device in scene.get('devices', []):
+            if device.get('device') is None:
+                raise RuntimeError('Device of scene %s without device idx' % scene['name'])
+        for timer in scene.get('timers', []):
+            if timer.get('type') is None or not timer.get('time'):
+                raise RuntimeError('Timer of scene %s without type or time' % scene['name'])
+
+def diff_specs(records, specs, fields):
+    """
+        Matches the current records of Domoticz to the desired specs, each
+        spec to at most one record with the same settings
 
         Arguments:
-        text -- user-input, typically transcribed speech
-        mic -- used to interact with the user (for both input and output)
-        profile -- contains information related to the user (e.g., Domoticz
-                   server address, username and password)
-        
+        records -- current records, e.g. the devices of a scene
+        specs -- desired settings, by their name in the desired state
+        fields -- (name, field, default) of the compared settings
+
         Returns:
-        The result of a command issued to Domoticz through Jasper
+        The records without a spec and the specs without a record
     """
-    def get_credentials():
+    def key(values, index):
+        return tuple(str(values.get(field[index], field[2])).lower() for field in fields)
+
+    wanted = collections.Counter(key(spec, 0) for spec in specs)
+    stale = []
+    for record in records:
+        record_key = key(record, 1)
+        if wanted[record_key] > 0:
+            wanted[record_key] -= 1
+        else:
+            stale.append(record)
+    missing = []
+    for spec in specs:
+        spec_key = key(spec, 0)
+        if wanted[spec_key] > 0:
+            wanted[spec_key] -= 1
+            missing.append(spec)
+    return stale, missing
+
+class CommandWorker(object):
+    """
+        Sends commands in the background on `size` threads. Commands for
+        the same entity always go to the same thread, so they are sent in
+        the order in which they were submitted. Every thread has a queue
+        of at most `queue_size` commands, submitting blocks while it is full.
+    """
+    def __init__(self, size=DEFAULT_POOL_SIZE, queue_size=DEFAULT_QUEUE_SIZE):
+        self.queues = [Queue.Queue(queue_size) for _ in range(size)]
+        for i, queue in enumerate(self.queues):
+            thread = threading.Thread(target=self._work, args=(queue,), name='domoticz-worker-%s' % i)
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, key, command, on_error=None):
         """
-            Get the server, username and password from profile
+            Queues a command
 
-            Returns:
-            Server url and encoded credentials for Domoticz server
+            Arguments:
+            key -- (kind, idx) of the commanded entity
+            command -- function without arguments that sends the command
+            on_error -- optional function called with the raised exception
+        """
+        self.queues[hash(key) % len(self.queues)].put((command, on_error))
+
+    def join(self):
+        """
+            Waits until all queued commands are sent
         """
-        server = profile['domoticz']['server']
-        username = profile['domoticz']['username']
-        password =  profile['domoticz']['password']
-        encoded_creds = encode_credentials(username, password)
-        return server, encoded_creds
+        for queue in self.queues:
+            queue.join()
+
+    def _work(self, queue):
+        while True:
+            command, on_error = queue.get()
+            try:
+                command()
+            except Exception as e:
+                logger.warning('Sending a Domoticz command failed', exc_info=True)
+                if on_error:
+                    try:
+                        on_error(e)
+                    except Exception:
+                        logger.warning('Reporting a failed Domoticz command failed', exc_info=True)
+            finally:
+                queue.task_done()
+
+class DomoticzLogSink(object):
+    """
+        Writes audit events to the Domoticz log, joining a batch into as
+        few `addlogmessage` requests as fit in AUDIT_MESSAGE_SIZE
+    """
+    def __init__(self, client):
+        self.client = client
+
+    def write(self, lines):
+        message = ''
+        for line in lines:
+            if message and len(message) + len(line) + 3 > AUDIT_MESSAGE_SIZE:
+                self.client.add_log_message(message)
+                message = ''
+            message = '%s | %s' % (message, line) if message else line
+        if message:
+            self.client.add_log_message(message)
+
+    def close(self):
+        pass
+
+class FileLogSink(object):
+    """
+        Writes audit events to a local file, one per line, which is rotated
+        once it exceeds `max_bytes` keeping `backups` rotated files
+    """
+    def __init__(self, path, max_bytes=DEFAULT_AUDIT_MAX_BYTES, backups=DEFAULT_AUDIT_BACKUPS):
+        self.handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes,
+                                                            backupCount=backups, delay=True)
+        self.handler.setFormatter(logging.Formatter('%(message)s'))
+
+    def write(self, lines):
+        for line in lines:
+            self.handler.handle(logging.makeLogRecord({'msg': line}))
+
+    def close(self):
+        self.handler.close()
 
-    def encode_credentials(username, password):
+class AuditLog(object):
+    """
+        Buffers audit events, such as commands and their responses, in
+        memory and writes them to a sink on a background thread, so
+        auditing costs no request while a command is handled. The buffer
+        is flushed once it holds `batch` events or `interval` seconds after
+        the first event it holds. At most `size` events are buffered, when
+        the sink cannot keep up the oldest are dropped; as are the events
+        of a batch the sink fails to write. Dropped events are counted in
+        `dropped` and reported in the next batch.
+    """
+    def __init__(self, sink, size=DEFAULT_AUDIT_SIZE, batch=DEFAULT_AUDIT_BATCH,
+                 interval=DEFAULT_AUDIT_INTERVAL):
+        self.sink = sink
+        self.batch = batch
+        self.interval = interval
+        self.events = collections.deque(maxlen=size)
+        self.dropped = 0
+        self.unreported = 0
+        self.closed = False
+        self.ready = threading.Condition()
+        self.thread = threading.Thread(target=self._flush_loop, name='domoticz-audit')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def record(self, message):
         """
-            Encode the credentials into a base64 encoded string
+            Buffers an event, prefixed with the current time
 
             Arguments:
-            username -- a username for the Domoticz server
-            password -- a password corresponding to the username
+            message -- description of the event
+        """
+        line = '%s %s' % (time.strftime('%Y-%m-%d %H:%M:%S'), message)
+        with self.ready:
+            if len(self.events) == self.events.maxlen:
+                self.dropped += 1
+                self.unreported += 1
+            self.events.append((time.time(), line))
+            # Wake the flusher to time the first event or flush a full batch
+            if len(self.events) == 1 or len(self.events) >= self.batch:
+                self.ready.notify()
+
+    def close(self, timeout=DEFAULT_TIMEOUT):
+        """
+            Flushes the buffered events and stops the background thread,
+            waiting at most `timeout` seconds
+        """
+        with self.ready:
+            self.closed = True
+            self.ready.notify()
+        self.thread.join(timeout)
+        self.sink.close()
+
+    def _flush_loop(self):
+        while True:
+            with self.ready:
+                while not self.closed:
+                    if len(self.events) >= self.batch:
+                        break
+                    if self.events:
+                        remaining = self.events[0][0] + self.interval - time.time()
+                        if remaining <= 0:
+                            break
+                        self.ready.wait(remaining)
+                    else:
+                        self.ready.wait()
+                lines = [line for recorded, line in self.events]
+                self.events.clear()
+                dropped, self.unreported = self.unreported, 0
+                closed = self.closed
+            if dropped:
+                logger.warning('Dropped %s audit events', dropped)
+                lines.insert(0, 'Dropped %s audit events' % dropped)
+            if lines:
+                self._write(lines)
+            if closed:
+                return
+
+    def _write(self, lines):
+        try:
+            self.sink.write(lines)
+        except Exception:
+            logger.warning('Writing %s audit events failed', len(lines), exc_info=True)
+            with self.ready:
+                self.dropped += len(lines)
+                self.unreported += len(lines)
+
+def create_audit_log(settings, client):
+    """
+        Creates the audit log configured by the `audit` setting, which is
+        either true to write to the Domoticz log of the client or a
+        dictionary with an optional `file` to write to instead, the
+        `max_bytes` and `backups` of that file and the `size`, `batch`
+        and `interval` of the AuditLog
+
+        Returns:
+        An AuditLog, or None if auditing is not configured
+    """
+    audit = settings.get('audit')
+    if not audit:
+        return None
+    if not isinstance(audit, dict):
+        audit = {}
+    if audit.get('file'):
+        sink = FileLogSink(audit['file'], audit.get('max_bytes', DEFAULT_AUDIT_MAX_BYTES),
+                           audit.get('backups', DEFAULT_AUDIT_BACKUPS))
+    else:
+        sink = DomoticzLogSink(client)
+    return AuditLog(sink, audit.get('size', DEFAULT_AUDIT_SIZE), audit.get('batch', DEFAULT_AUDIT_BATCH),
+                    audit.get('interval', DEFAULT_AUDIT_INTERVAL))
+
+class DomoticzClient(object):
+    """
+        Client for the Domoticz JSON API of the server in a profile. It keeps
+        the encoded credentials, the connection pool, the registry and, in
+        async mode, the command worker, so they survive between commands.
+        Use `get_client()` to share one client per server.
+
+        Requests time out after `timeout` seconds, failed reads are retried
+        up to `retries` times and a `CircuitBreaker` fails requests fast
+        while Domoticz is unreachable. Concurrent identical reads share
+        one request, commands are always sent.
+
+        With a `namespace` the idx of every entity is prefixed with it,
+        e.g. `annex:12`, so the entities of several servers can be merged.
+    """
+    def __init__(self, profile, namespace=None):
+        settings = profile['domoticz']
+        self.profile = profile
+        self.namespace = namespace
+        self.pool_size = settings.get('pool_size', DEFAULT_POOL_SIZE)
+        self.retries = settings.get('retries', DEFAULT_RETRIES)
+        server, encoded_creds = get_credentials(profile)
+        self.pool = ConnectionPool(server, encoded_creds, self.pool_size,
+                                   settings.get('timeout', DEFAULT_TIMEOUT))
+        self.breaker = CircuitBreaker(settings.get('breaker_threshold', DEFAULT_BREAKER_THRESHOLD),
+                                      settings.get('breaker_timeout', DEFAULT_BREAKER_TIMEOUT))
+        self.flights = SingleFlight()
+        self.registry = Registry(self, settings.get('ttl', DEFAULT_TTL),
+                                 settings.get('full_sync', DEFAULT_FULL_SYNC),
+                                 self.qualify_zones(settings.get('zones', {})), settings.get('snapshot'),
+                                 settings.get('fuzzy_threshold', DEFAULT_FUZZY_THRESHOLD))
+        if settings.get('mqtt'):
+            self.registry.feed = MqttFeed(self.registry, **settings['mqtt'])
+        self.worker = None
+        if settings.get('async'):
+            self.worker = CommandWorker(self.pool_size, settings.get('queue_size', DEFAULT_QUEUE_SIZE))
+        self.audit = create_audit_log(settings, self)
+
+    def start(self):
+        """
+            Starts the background refresher of the registry and the push feed
+        """
+        self.registry.start()
+        if self.registry.feed:
+            self.registry.feed.start()
+
+    def qualify(self, idx):
+        """
+            Returns:
+            The idx prefixed with the namespace, if any
+        """
+        if self.namespace is None:
+            return str(idx)
+        return '%s:%s' % (self.namespace, idx)
 
+    def qualify_records(self, records):
+        """
+            Prefixes the `idx` and `devidx` of records with the namespace
+        """
+        if self.namespace is None or not isinstance(records, list):
+            return
+        for record in records:
+            if isinstance(record, dict):
+                for field in ['idx', 'devidx']:
+                    if field in record:
+                        record[field] = self.qualify(record[field])
+
+    def qualify_zones(self, zones):
+        return dict((name, dict((field, self.qualify(idx)) for field, idx in zone.items()))
+                    for name, zone in zones.items())
+
+    def localize(self, arg):
+        """
             Returns:
-            Encoded string of credentials
+            The settings of a json request without the namespace of the idx
         """
-        return base64.encodestring('%s:%s' % (username, password)).replace('\n', '')
+        if self.namespace is None:
+            return arg
+        return arg.replace('=%s:' % self.namespace, '=')
 
-    def send_request(url):
+    def send_request(self, url, idempotent=False):
         """
             Sends a json request to the Domoticz server
-            The request is appended to the server url and
-            the encoded credentials are added to the header
+            The request is appended to the server url and sent
+            over a pooled connection with the encoded credentials
 
             Arguments:
             url -- json url which request a json object
+            idempotent -- whether the request may be retried
 
             Returns:
-            Response to json request
+            Response to json request. If Domoticz does not respond an
+            UnreachableError is raised.
         """
-        server, encoded_creds = get_credentials()
-        request = urllib2.Request(server + url)
-        request.add_header("Authorization", "Basic %s" % encoded_creds)
-        response = urllib2.urlopen(request)
-        return response.read()
+        attempt = 0
+        while True:
+            self.check_reachable()
+            try:
+                body = self.pool.request(url)
+            except REQUEST_ERRORS as error:
+                if self._failed(error, attempt, idempotent):
+                    attempt += 1
+                    continue
+                if isinstance(error, urllib2.HTTPError):
+                    raise
+                raise UnreachableError('Domoticz is unreachable: %s' % error)
+            self.breaker.succeeded()
+            return body
+
+    def check_reachable(self):
+        """
+            Raises an UnreachableError while the circuit breaker is open,
+            unless the caller gets to probe the server and it responds
+        """
+        if not self.breaker.is_open():
+            return
+        if self.breaker.acquire_probe():
+            try:
+                self.pool.request('/json.htm?type=command&param=getversion')
+            except REQUEST_ERRORS as error:
+                if is_transient(error):
+                    self.breaker.failed()
+                    raise UnreachableError('Domoticz is unreachable: %s' % error)
+            self.breaker.succeeded()
+            return
+        raise UnreachableError('Domoticz is unreachable')
+
+    def _failed(self, error, attempt, retry):
+        """
+            Records a failed request with the circuit breaker and, if it is
+            to be retried, waits a random backoff
+
+            Arguments:
+            error -- the raised exception
+            attempt -- number of the failed attempt, starting at 0
+            retry -- whether the request may be retried
 
-    def get_json_obj(type, arg):
+            Returns:
+            True if the request is to be retried
         """
-            Gets a json object from a json url
+        if not is_transient(error):
+            # Domoticz responded, the request itself is wrong
+            self.breaker.succeeded()
+            return False
+        self.breaker.failed()
+        if not retry or attempt >= self.retries or self.breaker.is_open():
+            return False
+        if DEBUG: print 'retrying after %s' % error
+        time.sleep(random.uniform(0, RETRY_BACKOFF * 2 ** attempt))
+        return True
+
+    def get_json_response(self, type, arg):
+        """
+            Gets the complete json response from a json url
 
             Arguments:
             type -- type of json request
             arg -- additional settings for json request
 
             Returns:
-            If response from send_request() contains field
-            `result`, `results` is returned, else None is returned
+            The decoded response, including fields such as `ActTime`.
             If an invalid json request was made, an error is raised.
+            Concurrent identical reads share the response, which must not
+            be modified.
         """
-        url = '/json.htm?type=' + type + arg
+        url = '/json.htm?type=' + type + self.localize(arg)
         if DEBUG: print url
-        obj = json.loads(send_request(url))
+        idempotent = is_idempotent(type, arg)
+
+        def fetch():
+            with timings.measure('request:' + request_label(type, arg)):
+                body = self.send_request(url, idempotent)
+            with timings.measure('decode'):
+                try:
+                    obj = json.loads(body)
+                except ValueError as error:
+                    raise RuntimeError('Invalid json response from Domoticz: %s' % error)
+            if isinstance(obj, dict):
+                self.qualify_records(obj.get('result'))
+            return obj
+
+        obj = self.flights.do(url, fetch) if idempotent else fetch()
         if not is_status_ok(obj):
             raise RuntimeError('Object not retrieved from Domoticz')
-        if 'result' in obj:
-            return obj['result']
+        return obj
+
+    def iter_json_records(self, type, arg, fields=None, meta=None):
+        """
+            Streams the records of the `result` of a json url, parsing the
+            response while it is read
+
+            Arguments:
+            type -- type of json request
+            arg -- additional settings for json request
+            fields -- names of the fields to keep of each record, or None
+            meta -- dictionary that receives the other fields of the response
+
+            Returns:
+            Generator of records. If an invalid json request was made, an
+            error is raised once the response is read completely. Reads
+            that fail before the first record are retried.
+        """
+        url = '/json.htm?type=' + type + self.localize(arg)
+        if DEBUG: print url
+        if meta is None:
+            meta = {}
+        idempotent = is_idempotent(type, arg)
+        attempt = 0
+        while True:
+            self.check_reachable()
+            meta.clear()
+            streaming = False
+            start = time.time()
+            try:
+                with self.pool.open(url) as response:
+                    timings.record('request:' + request_label(type, arg), time.time() - start)
+                    elapsed, start = 0, time.time()
+                    for record in iter_json_records(response, fields, meta):
+                        self.qualify_records([record])
+                        elapsed += time.time() - start
+                        streaming = True
+                        yield record
+                        start = time.time()
+                    timings.record('decode', elapsed + time.time() - start)
+            except REQUEST_ERRORS as error:
+                if self._failed(error, attempt, idempotent and not streaming):
+                    attempt += 1
+                    continue
+                if isinstance(error, urllib2.HTTPError):
+                    raise
+                raise UnreachableError('Domoticz is unreachable: %s' % error)
+            except ValueError as error:
+                # Domoticz, or a proxy in front of it, responded with something else than json
+                self.breaker.succeeded()
+                raise RuntimeError('Invalid json response from Domoticz: %s' % error)
+            self.breaker.succeeded()
+            break
+        if not is_status_ok(meta):
+            raise RuntimeError('Object not retrieved from Domoticz')
+
+    def get_json_records(self, type, arg, fields=None):
+        """
+            Gets all records of the `result` of a json url, streamed as
+            by iter_json_records()
+
+            Arguments:
+            type -- type of json request
+            arg -- additional settings for json request
+            fields -- names of the fields to keep of each record, or None
+
+            Returns:
+            The list of records and a dictionary with the other fields of
+            the response. Concurrent identical reads share them, they must
+            not be modified.
+        """
+        def fetch():
+            meta = {}
+            return list(self.iter_json_records(type, arg, fields, meta)), meta
 
-    def is_status_ok(obj):
+        if is_idempotent(type, arg):
+            return self.flights.do((type, arg, fields), fetch)
+        return fetch()
+
+    def get_json_obj(self, type, arg):
         """
-            Check if json object was properly retrieved
+            Gets a json object from a json url
 
             Arguments:
-            obj -- json object to check
+            type -- type of json request
+            arg -- additional settings for json request
 
             Returns:
-            Boolean result of status check 
+            If response from send_request() contains field
+            `result`, `results` is returned, else None is returned
+            If an invalid json request was made, an error is raised.
         """
-        return obj['status'] == 'OK'
+        obj = self.get_json_response(type, arg)
+        if 'result' in obj:
+            return obj['result']
 
-    def send_command(param, arg):
+    def send_command(self, param, arg):
         """
             Send a command to the Domoticz server
 
@@ -128,31 +2251,65 @@ def handle(text, mic, profile):
             Returns:
             Result of get_json_obj() of type `command`
         """
-        return get_json_obj('command', '&param=%s%s' % (param, arg))
+        return self.get_json_obj('command', '&param=%s%s' % (param, arg))
+
+    def dispatch_command(self, key, param, arg, on_error=None, **fields):
+        """
+            Send a command that changes the state of an entity and write
+            the new state through to the registry. In async mode the state
+            is written through right away and the command is queued on the
+            worker, a failure reverts the state and is passed to `on_error`.
+
+            Arguments:
+            key -- (kind, idx) of the commanded entity
+            param -- parameters of the command
+            arg -- additional settings for the command
+            on_error -- optional function called with the key and exception
+                        of a failed command in async mode
+            fields -- new values of the entity, e.g. Status='On'
+        """
+        if self.worker is None:
+            self.send_command(param, arg)
+            self.registry.write_through(key, **fields)
+            return
 
-    def send_light_command(idx, cmd):
+        def report(error):
+            self.registry.revert(key)
+            if on_error:
+                on_error(key, error)
+
+        self.registry.write_through(key, **fields)
+        self.worker.submit(key, lambda: self.send_command(param, arg), report)
+
+    def send_light_command(self, idx, cmd, on_error=None):
         """
             Send a light command to the Domoticz server
 
             Arguments:
             idx -- index of light to command
             cmd -- switch command ['on', 'off', 'toggle']
-            
+            on_error -- see dispatch_command()
         """
-        send_command('switchlight', '&idx=%s&switchcmd=%s' % (idx, cmd.title()))
-
-    def send_thermostat_command(idx, sp):
+        status = cmd.title()
+        if cmd == 'toggle':
+            light = self.registry.get(('light', idx))
+            status = 'Off' if light and light.state == 'on' else 'On'
+        self.dispatch_command(('light', idx), 'switchlight',
+                              '&idx=%s&switchcmd=%s' % (idx, cmd.title()), on_error, Status=status)
+
+    def send_thermostat_command(self, idx, sp, on_error=None):
         """
             Send a thermostat command to the Domoticz server
 
             Arguments:
             idx -- index of thermostat to command
             sp -- new setpoint of thermostat
-            
+            on_error -- see dispatch_command()
         """
-        send_command('setsetpoint', '&idx=%s&setpoint=%s' % (idx, sp))
+        self.dispatch_command(('utility', idx), 'setsetpoint',
+                              '&idx=%s&setpoint=%s' % (idx, sp), on_error, SetPoint=sp)
 
-    def send_scene_command(idx, cmd):
+    def send_scene_command(self, idx, cmd, on_error=None):
         """
             Send a scene/group command to the Domoticz server
             Scenes can only be turned on but devices in 
@@ -162,10 +2319,34 @@ def handle(text, mic, profile):
             Arguments:
             idx -- index of scene/group to command
             cmd -- scene/group command ['on', 'off']
+            on_error -- see dispatch_command()
+        """
+        self.dispatch_command(('scene', idx), 'switchscene',
+                              '&idx=%s&switchcmd=%s' % (idx, cmd.title()), on_error, Status=cmd.title())
+
+    def send_batch_command(self, targets, cmd, on_error=None):
         """
-        send_command('switchscene', '&idx=%s&switchcmd=%s' % (idx, cmd.title()))
+            Send a command to several lights, scenes and/or groups
+            concurrently, using at most `pool_size` threads
+
+            Arguments:
+            targets -- list of (kind, idx) keys, where kind is `scene`
+                       for scenes/groups and a device filter otherwise
+            cmd -- switch command ['on', 'off', 'toggle']
+            on_error -- see dispatch_command()
 
-    def get_rooms(order='name', used='true'):
+            Returns:
+            List with for each target None on success or the raised exception
+        """
+        calls = []
+        for kind, idx in targets:
+            if kind == 'scene':
+                calls.append(lambda idx=idx: self.send_scene_command(idx, cmd, on_error))
+            else:
+                calls.append(lambda idx=idx: self.send_light_command(idx, cmd, on_error))
+        return [error for result, error in run_concurrently(calls, self.pool_size)]
+
+    def get_rooms(self, order='name', used='true'):
         """
             Returns a list of all roomplans
 
@@ -176,30 +2357,35 @@ def handle(text, mic, profile):
             Returns:
             List of all roomplans
         """
-        return get_json_obj('plans', '&order=%s&used=%s' % (order, used))
+        return self.get_json_obj('plans', '&order=%s&used=%s' % (order, used))
 
-    def get_scenes():
+    def get_scenes(self):
         """
             Returns a list of all scenes/groups
 
             Returns:
             List of all scenes/groups
         """
-        return get_json_obj('scenes', '')
+        return self.get_json_obj('scenes', '')
 
-    def get_device(idx):
+    def get_device(self, idx, fields=None):
         """
-            Returns json data for specific device
+            Returns json data for specific device, the response is only
+            read up to the device
 
             Arguments:
             idx -- index of device
+            fields -- names of the fields to keep, or None for all
 
             Returns:
-            json data for device
+            List with the json data for device, or an empty list
         """
-        return get_json_obj('devices', '&rid=%s' % idx)
+        for device in self.iter_json_records('devices', '&rid=%s' % idx, fields):
+            if device.get('idx') == str(idx):
+                return [device]
+        return []
 
-    def get_devices(filter='all', used='true', order='Name'):
+    def get_devices(self, filter='all', used='true', order='Name'):
         """
             Returns a list of all devices
 
@@ -211,9 +2397,9 @@ def handle(text, mic, profile):
             Returns:
             List of all devices
         """
-        return get_json_obj('devices', '&filter=%s&used=%s&order=%s' % (filter, used, order))
+        return self.get_json_obj('devices', '&filter=%s&used=%s&order=%s' % (filter, used, order))
 
-    def get_devices_in_room(idx, filter='all'):
+    def get_devices_in_room(self, idx, filter='all'):
         """
             Returns a list of all devices in a roomplan
 
@@ -224,9 +2410,9 @@ def handle(text, mic, profile):
             Returns:
             A list of all devices in room
         """
-        return send_command('getplandevices', '&idx=%s&filter=%s' % (idx, filter))
+        return self.send_command('getplandevices', '&idx=%s&filter=%s' % (idx, filter))
 
-    def get_devices_in_scene(idx, filter='all'):
+    def get_devices_in_scene(self, idx, filter='all'):
         """
             Returns a list of all devices in a scene/group
 
@@ -237,115 +2423,523 @@ def handle(text, mic, profile):
             Returns:
             A list of all devices in scene/group
         """
-        return send_command('getscenedevices', '&idx=%s&isscene=true&filter=%s' % (idx, filter))
+        return self.send_command('getscenedevices', '&idx=%s&isscene=true&filter=%s' % (idx, filter))
 
-    def get_lights():
+    def get_lights(self):
         """
-            Call to `get_devices()` with filter `light` 
-            and returns a list of all lights
+            Returns the cached list of all lights from the registry
 
             Returns:
             A list of all lights
         """
-        return get_devices(filter='light')
+        return self.registry.get_devices('light')
 
-    def get_thermostats():
+    def get_thermostats(self):
         """
-            Calls get_devices() with filter `temp` to get all thermostats
-            and `utility` to get all setpoints. If the `hardwarename` of
-            thermostat and setpoint coincide then setpoint and its idx are
-            added to the thermostat dictionary.
+            Returns the thermostats from the registry, in which devices with
+            filter `temp` are joined with the `utility` setpoints of the same
+            `hardwarename`, adding the setpoint and its idx.
             
             Returns:
-            Dictionary of thermostats
+            List of thermostats
         """
-        thermostats = get_devices('temp')
-        setpoints = get_devices('utility')
-        for thermostat in thermostats:
-            for setpoint in setpoints: 
-                if thermostat['HardwareName'] == setpoint['HardwareName']:
-                    thermostat['SetPoint'] = setpoint['SetPoint']
-                    thermostat['SetPointIdx'] = setpoint['idx']
-        return thermostats
+        return self.registry.get_thermostats()
 
-    def get_timers_in_scene(idx):
-        return get_json_obj('scenetimers', '&idx=%s' % idx)
+    def get_timers_in_scene(self, idx):
+        return self.get_json_obj('scenetimers', '&idx=%s' % idx)
 
     # Helper methods:
-    def add_log_message(msg):
+    def add_log_message(self, msg):
         """
             Adds a message in the Domoticz log
 
             Arguments:
             msg -- string to add as message
         """
-        send_command('addlogmessage', '&message=%s' % msg)
+        self.send_command('addlogmessage', '&message=%s' % quote_arg(msg))
 
-    def get_sunrise_sunset():
+    def get_sunrise_sunset(self):
         """
             Retrieve sun-rise/set times from Domoticz
 
             Returns:
             Dictionary of sun-rise/set times
         """
-        return send_command('getSunRiseSet', '')
-        
-    def jsonprettyprint(obj):
+        return self.send_command('getSunRiseSet', '')
+
+    # Provisioning methods, used by provision() or directly:
+    def add_room(self, name):
+        self.send_command('addplan', '&name=%s' % quote_arg(name))
+
+    def delete_room(self, idx):
+        self.send_command('deleteplan', '&idx=%s' % idx)
+
+    def add_scene(self, name, group=False):
+        self.get_json_obj('addscene', '&name=%s&scenetype=%s' % (quote_arg(name), str(int(group))))
+
+    def delete_scene(self, idx):
+        self.get_json_obj('deletescene', '&idx=%s' % idx)
+
+    def add_device_to_scene(self, devidx, idx, group=False, cmd='on', 
+                            lvl='100', hue='0', ondelay='', offdelay=''):
+        self.send_command('addscenedevice', 
+                          '&idx=%s&isscene=%s&devidx=%s&command=%s&level=%s&hue=%s&ondelay=%s&offdelay=%s' % (idx, str(not group).lower(), devidx, cmd.title(), lvl, hue, ondelay, offdelay))
+
+    def delete_device_from_scene(self, idx):
+        self.send_command('deletescenedevice', '&idx=%s' % idx)
+
+    def add_timer_to_scene(self, idx, timertype, cmd, date='', hour='', min='', randomness='', level='', days='', active='true'):
+        self.send_command('addscenetimer', 
+                          '&idx=%s&active=%s&timertype=%s&date=%s&hour=%s&min=%s&randomness=%s&command=%s&level=%s&days=%s' % (idx, active, timertype, date, hour, min, randomness, cmd, level, days))
+
+    def delete_timer_from_scene(self, idx):
+        self.send_command('deletescenetimer', '&idx=%s' % idx)
+
+    def provision(self, state, prune=False, dry_run=False):
         """
-            Formats json object into human-readable print
+            Brings the rooms, scenes/groups and their devices and timers in
+            Domoticz in line with a desired state. The current state is read
+            once, rooms and scenes are matched by name and scene devices and
+            timers by their settings, and only the differences are deleted
+            and then created, concurrently using at most `pool_size` threads.
+            Created scenes are read again to learn their idx.
 
             Arguments:
-            obj -- json object to format
+            state -- dictionary with the desired `rooms`, a list of names,
+                     and `scenes`, a list of dictionaries with the `name`,
+                     optionally `group: true`, and the `devices` and
+                     `timers` of a scene, see SCENE_DEVICE_FIELDS and
+                     SCENE_TIMER_FIELDS for their settings
+            prune -- whether rooms and scenes not in the state are deleted
+            dry_run -- whether to only list the changes
+
+            Returns:
+            List of (change, exception) of the changes in the order they
+            were applied, where exception is None if the change succeeded
+            or was not applied
+        """
+        check_state(state)
+        reads = run_concurrently([self.get_rooms, self.get_scenes], 2)
+        for result, error in reads:
+            if error:
+                raise error
+        plans, scenes = [result or [] for result, error in reads]
+        deletes, creates = [], []
+
+        rooms = set(plan['Name'].lower() for plan in plans)
+        wanted_rooms = set(name.lower() for name in state.get('rooms', []))
+        for name in state.get('rooms', []):
+            if name.lower() not in rooms:
+                creates.append(('add room %s' % name, lambda name=name: self.add_room(name)))
+        for plan in plans:
+            if prune and plan['Name'].lower() not in wanted_rooms:
+                deletes.append(('delete room %s' % plan['Name'], lambda idx=plan['idx']: self.delete_room(idx)))
+
+        existing = dict((scene['Name'].lower(), scene) for scene in scenes)
+        wanted_scenes = set(spec['name'].lower() for spec in state.get('scenes', []))
+        kept, created = [], []
+        for spec in state.get('scenes', []):
+            scene = existing.get(spec['name'].lower())
+            group = bool(spec.get('group'))
+            if scene and (scene['Type'] == 'Group') != group:
+                # The type of a scene cannot be changed, it is recreated
+                deletes.append(('delete %s %s' % (scene['Type'].lower(), scene['Name']),
+                                lambda idx=scene['idx']: self.delete_scene(idx)))
+                scene = None
+            if scene:
+                kept.append((spec, scene))
+            else:
+                created.append(spec)
+                creates.append(('add %s %s' % ('group' if group else 'scene', spec['name']),
+                                lambda spec=spec, group=group: self.add_scene(spec['name'], group)))
+        for scene in scenes:
+            if prune and scene['Name'].lower() not in wanted_scenes:
+                deletes.append(('delete %s %s' % (scene['Type'].lower(), scene['Name']),
+                                lambda idx=scene['idx']: self.delete_scene(idx)))
+
+        calls = []
+        for spec, scene in kept:
+            calls.append(lambda idx=scene['idx']: self.get_devices_in_scene(idx))
+            calls.append(lambda idx=scene['idx']: self.get_timers_in_scene(idx))
+        reads = run_concurrently(calls, self.pool_size)
+        for result, error in reads:
+            if error:
+                raise error
+        for i, (spec, scene) in enumerate(kept):
+            scene_deletes, scene_creates = self._scene_changes(spec, scene['idx'], reads[2 * i][0] or [],
+                                                               reads[2 * i + 1][0] or [])
+            deletes.extend(scene_deletes)
+            creates.extend(scene_creates)
+
+        if dry_run:
+            for spec in created:
+                creates.extend(self._scene_changes(spec, None, [], [])[1])
+            return [(change, None) for change, call in deletes + creates]
+        results = self._apply(deletes) + self._apply(creates)
+        if created:
+            scenes = dict((scene['Name'].lower(), scene) for scene in self.get_scenes() or [])
+            creates = []
+            for spec in created:
+                scene = scenes.get(spec['name'].lower())
+                if scene:
+                    creates.extend(self._scene_changes(spec, scene['idx'], [], [])[1])
+            results += self._apply(creates)
+        if results:
+            self.registry.invalidate()
+        return results
+
+    def _scene_changes(self, spec, idx, devices, timers):
+        """
+            Returns:
+            The deletes and creates, as lists of (change, call), that bring
+            the current devices and timers of a scene in line with its spec
+        """
+        name, group = spec['name'], bool(spec.get('group'))
+        deletes, creates = [], []
+        stale, missing = diff_specs(devices, [normalize_device(device) for device in spec.get('devices', [])],
+                                    SCENE_DEVICE_FIELDS)
+        for device in stale:
+            deletes.append(('delete device %s from %s' % (device['DevID'], name),
+                            lambda row=device['ID']: self.delete_device_from_scene(row)))
+        for device in missing:
+            creates.append(('add device %s to %s' % (device['device'], name),
+                            lambda device=device: self.add_device_to_scene(
+                                device['device'], idx, group, device['command'],
+                                device.get('level', 100), device.get('hue', 0),
+                                device.get('ondelay', 0), device.get('offdelay', 0))))
+        stale, missing = diff_specs(timers, [normalize_timer(timer) for timer in spec.get('timers', [])],
+                                    SCENE_TIMER_FIELDS)
+        for timer in stale:
+            deletes.append(('delete timer at %s from %s' % (timer['Time'], name),
+                            lambda row=timer['idx']: self.delete_timer_from_scene(row)))
+        for timer in missing:
+            hour, minute = timer['time'].split(':')
+            creates.append(('add timer at %s to %s' % (timer['time'], name),
+                            lambda timer=timer, hour=hour, minute=minute: self.add_timer_to_scene(
+                                idx, timer['type'], timer['command'], timer.get('date', ''), hour, minute,
+                                str(timer.get('randomness', False)).lower(), timer.get('level', 100),
+                                timer.get('days', 128), str(timer.get('active', True)).lower())))
+        return deletes, creates
+
+    def _apply(self, changes):
+        """
+            Applies (change, call) concurrently
 
             Returns:
-            String with pretty printed json object
+            List of (change, exception) as returned by provision()
         """
-        return json.dumps(obj, sort_keys=True, 
-                          indent=2, separators=(',', ': '))
+        results = run_concurrently([call for change, call in changes], self.pool_size)
+        return [(change, error) for (change, call), (result, error) in zip(changes, results)]
 
-    def timeit(ref_t=None):
+    def close(self):
         """
-            Method to determine elapsed time between calls
-            If reference time is provided, the elapsed time 
-            since the reference time is printed.
-            
-            Arguments:
-            ref_t -- reference time to calculate elapsed time
+            Flushes the audit log and closes the idle connections to the
+            server and the push feed
+        """
+        if self.audit:
+            self.audit.close()
+        self.pool.close()
+        if self.registry.feed:
+            self.registry.feed.stop()
 
+class FederatedClient(object):
+    """
+        Client for several Domoticz servers, e.g. one per building, listed
+        under `servers` in the profile. Every server gets a DomoticzClient
+        whose entities are namespaced by the `name` of the server, commands
+        are sent to the server that owns the entity and a FederatedRegistry
+        merges the registries. Events are audited to the log of the first
+        server. The idx of a zone only has a meaning on its own server, so
+        `zones` are listed per server.
+    """
+    def __init__(self, profile):
+        settings = dict(profile['domoticz'])
+        servers = settings.pop('servers')
+        audit = settings.pop('audit', None)
+        if 'zones' in settings:
+            raise RuntimeError('List the Domoticz zones under the server of their thermostat')
+        self.profile = profile
+        self.members = collections.OrderedDict()
+        for server in servers:
+            name = server.get('name') or urlparse.urlparse(server['server']).hostname
+            if name in self.members:
+                raise RuntimeError('Domoticz server name %s is not unique' % name)
+            member = dict(settings, **server)
+            if 'snapshot' in settings and 'snapshot' not in server:
+                member['snapshot'] = '%s.%s' % (settings['snapshot'], name)
+            self.members[name] = DomoticzClient({'domoticz': member}, name)
+        self.registry = FederatedRegistry(self)
+        self.worker = None
+        self.audit = create_audit_log({'audit': audit}, self.members.values()[0])
+
+    def owner(self, idx):
+        """
             Returns:
-            Current time
+            The client of the server whose namespace prefixes the idx
         """
-        import time
-        t = time.time()
-        # t = time.clock()
-        if ref_t: print 'elapsed time:', t-ref_t
-        return t
-        
-    # Methods used for testing/debugging:
-    # currently not used directly but could be if desired
-    def add_room(name):
-        send_command('addplan', '&name=%s' % name)
+        namespace = str(idx).split(':', 1)[0]
+        if namespace not in self.members:
+            raise RuntimeError('No Domoticz server named %s' % namespace)
+        return self.members[namespace]
 
-    def delete_room(idx):
-        send_command('deleteplan', '&idx=%s' % idx)
+    def start(self):
+        for member in self.members.values():
+            member.start()
 
-    def add_scene(name, group=False):
-        get_json_obj('addscene', '&name=%s&scenetype=%s' % (name, str(int(group))))
+    def send_light_command(self, idx, cmd, on_error=None):
+        self.owner(idx).send_light_command(idx, cmd, on_error)
 
-    def delete_scene(idx):
-        get_json_obj('deletescene', '&idx=%s' % idx)
+    def send_thermostat_command(self, idx, sp, on_error=None):
+        self.owner(idx).send_thermostat_command(idx, sp, on_error)
 
-    def add_device_to_scene(devidx, idx, group=False, cmd='on', 
-                            lvl='100', hue='0', ondelay='', offdelay=''):
-        send_command('addscenedevice', 
-                     '&idx=%s&isscene=%s&devidx=%s&command=%s&level=%s&hue=%s&ondelay=%s&offdelay=%s' % (idx, str(not group).lower(), devidx, cmd.title(), lvl, hue, ondelay, offdelay))
+    def send_scene_command(self, idx, cmd, on_error=None):
+        self.owner(idx).send_scene_command(idx, cmd, on_error)
+
+    def send_batch_command(self, targets, cmd, on_error=None):
+        """
+            Sends a command to several lights, scenes and/or groups, with
+            the targets of every server sent concurrently
+
+            Returns:
+            List with for each target None on success or the raised exception
+        """
+        positions = collections.OrderedDict()
+        for i, (kind, idx) in enumerate(targets):
+            positions.setdefault(self.owner(idx), []).append(i)
+        calls = [lambda member=member, indices=indices:
+                 member.send_batch_command([targets[i] for i in indices], cmd, on_error)
+                 for member, indices in positions.items()]
+        errors = [None] * len(targets)
+        for indices, (result, error) in zip(positions.values(), run_concurrently(calls, len(calls))):
+            for i, target_error in zip(indices, result or [error] * len(indices)):
+                errors[i] = target_error
+        return errors
+
+    def get_lights(self):
+        return self.registry.get_devices('light')
+
+    def get_thermostats(self):
+        return self.registry.get_thermostats()
+
+    def close(self):
+        if self.audit:
+            self.audit.close()
+        for member in self.members.values():
+            member.close()
+
+class FederatedRegistry(object):
+    """
+        Merged view of the registries of the servers of a FederatedClient.
+        Lookups by key or idx go to the registry of the server in its
+        namespace and searches combine all registries. Registries are
+        refreshed in parallel, a server that is down is skipped.
+    """
+    def __init__(self, client):
+        self.client = client
+
+    def registries(self):
+        return [member.registry for member in self.client.members.values()]
+
+    def ensure_fresh(self):
+        """
+            Refreshes the stale registries in parallel. An error is only
+            raised if no server could be refreshed.
+        """
+        registries = self.registries()
+        results = run_concurrently([registry.ensure_fresh for registry in registries], len(registries))
+        errors = []
+        for name, (result, error) in zip(self.client.members, results):
+            if error:
+                logger.warning('Refreshing Domoticz server %s failed: %s', name, error)
+                errors.append(error)
+        if errors and len(errors) == len(registries):
+            raise errors[0]
+
+    def find(self, words, kinds, members=None):
+        """
+            Finds the entities named in an utterance in all registries, see
+            Registry.find(), or only in those of the servers whose names are
+            in the utterance. Names found at the same position by several
+            registries are merged and the longest names are preferred.
+        """
+        utterance = ' %s ' % ' '.join(words)
+        named = [member.registry for name, member in self.client.members.items()
+                 if ' %s ' % ' '.join(tokenize(name)) in utterance]
+        spans = {}
+        for registry in named or self.registries():
+            start = 0
+            for phrase, matches in registry.find(words, kinds, members):
+                tokens = phrase.split()
+                for i in range(start, len(words) - len(tokens) + 1):
+                    if words[i:i + len(tokens)] == tokens:
+                        spans.setdefault((i, i + len(tokens)), (phrase, []))[1].extend(matches)
+                        start = i + len(tokens)
+                        break
+        found, end = [], 0
+        for i, j in sorted(spans, key=lambda span: (span[0], span[0] - span[1])):
+            if i >= end:
+                found.append(spans[(i, j)])
+                end = j
+        return found
+
+    def named_kinds(self, words):
+        return set(kind for registry in self.registries() for kind in registry.named_kinds(words))
+
+    def get(self, key):
+        if key[0] == 'zone':
+            for registry in self.registries():
+                entity = registry.get(key)
+                if entity is not None:
+                    return entity
+            return None
+        return self.client.owner(key[1]).registry.get(key)
+
+    def get_state(self, key):
+        return self.client.owner(key[1]).registry.get_state(key)
+
+    def get_devices(self, filter):
+        return [device for registry in self.registries() for device in registry.get_devices(filter)]
+
+    def get_scenes(self):
+        return [scene for registry in self.registries() for scene in registry.get_scenes()]
+
+    def get_rooms(self):
+        return [room for registry in self.registries() for room in registry.get_rooms()]
+
+    def get_room_members(self, idx):
+        return self.client.owner(idx).registry.get_room_members(idx)
+
+    def refresh_room(self, idx):
+        self.client.owner(idx).registry.refresh_room(idx)
+
+    def get_rooms_of(self, key):
+        return self.client.owner(key[1]).registry.get_rooms_of(key)
+
+    def get_thermostats(self):
+        return [thermostat for registry in self.registries() for thermostat in registry.get_thermostats()]
+
+    def get_thermostat(self, idx):
+        return self.client.owner(idx).registry.get_thermostat(idx)
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_client(profile):
+    """
+        Returns the shared client for the Domoticz server in profile, or a
+        FederatedClient if it lists several `servers`, creating it and
+        starting the background refresher of its registry on first use
+
+        Arguments:
+        profile -- contains the Domoticz server address, credentials and
+                   optional settings such as `ttl`, `full_sync`, `pool_size`,
+                   `zones`, `snapshot`, `fuzzy_threshold`, `mqtt`, `async`,
+                   `queue_size`, `timeout`, `retries`, `breaker_threshold`,
+                   `breaker_timeout` and `audit`
+    """
+    settings = profile['domoticz']
+    if 'servers' in settings:
+        server = tuple(member['server'] for member in settings['servers'])
+    else:
+        server = settings['server']
+    with _clients_lock:
+        client = _clients.get(server)
+        if client is None:
+            if 'servers' in settings:
+                client = FederatedClient(profile)
+            else:
+                client = DomoticzClient(profile)
+            client.start()
+            _clients[server] = client
+    return client
+
+def load_profile():
+    """
+        Loads the Jasper profile, so the names of entities are known before
+        the first command creates a client
+
+        Returns:
+        The profile, or None if it cannot be loaded outside of Jasper
+    """
+    if jasperpath is None:
+        return None
+    try:
+        with open(jasperpath.config('profile.yml')) as f:
+            return yaml.safe_load(f)
+    except (IOError, yaml.YAMLError):
+        logger.warning('Loading the Jasper profile failed', exc_info=True)
+        return None
+
+def jsonprettyprint(obj):
+    """
+        Formats json object into human-readable print
+
+        Arguments:
+        obj -- json object to format
+
+        Returns:
+        String with pretty printed json object
+    """
+    return json.dumps(obj, sort_keys=True, 
+                      indent=2, separators=(',', ': '))
+
+def join_names(names):
+    """
+        Joins names into a spoken enumeration, e.g. `a, b and c`
+    """
+    if len(names) == 1:
+        return names[0]
+    return '%s and %s' % (', '.join(names[:-1]), names[-1])
+
+def handle(text, mic, profile):
+    """
+        Responds to user-input, typically speech text, with the result of
+        a command given by the user to control devices, scenes and/or groups
+        in different rooms through the Domoticz JSON API.
+
+        Arguments:
+        text -- user-input, typically transcribed speech
+        mic -- used to interact with the user (for both input and output)
+        profile -- contains information related to the user (e.g., Domoticz
+                   server address, username and password)
+        
+        Returns:
+        The result of a command issued to Domoticz through Jasper
+    """
+    def report_failure(key, error):
+        """
+            Reports a command that failed in async mode
+
+            Arguments:
+            key -- (kind, idx) of the commanded entity
+            error -- the raised exception
+        """
+        entity = registry.get(key)
+        name = entity.name if entity else 'device'
+        mic.say('Sorry, the command for the %s failed' % name)
+
+    def find_entities(kinds, members=None):
+        """
+            Finds the entities of the given kinds named in the text,
+            preferring the longest names
 
-    def delete_device_from_scene(idx):
-        send_command('deletescenedevice', '&idx=%s' % idx)
+            Arguments:
+            kinds -- kinds of entities to look for, e.g. ['light']
+            members -- optional set of (kind, idx) keys to restrict the search to
 
-    def add_timer_to_scene(idx, timertype, cmd, date='', hour='', min='', randomness='', level='', days='', active='true'):
-        send_command('addscenetimer', 
-                     '&idx=%s&active=%s&timertype=%s&date=%s&hour=%s&min=%s&randomness=%s&command=%s&level=%s&days=%s' % (idx, active, timertype, date, hour, min, randomness, cmd, lvl, days))
+            Returns:
+            List of distinct (key, entity) in order of appearance and the
+            first name shared by several entities, or None
+        """
+        found, ambiguous = [], None
+        with timings.measure('lookup'):
+            matches = registry.find(text, kinds, members)
+        for name, matches in matches:
+            if len(matches) > 1:
+                ambiguous = ambiguous or name
+            elif matches[0] not in found:
+                found.append(matches[0])
+        return found, ambiguous
 
     # To-do: possible to refactor all device calls?
     def handle_device(device):
@@ -366,43 +2960,142 @@ def handle(text, mic, profile):
             Returns:
             The result of a `light` command issued to Domoticz through Jasper
         """
-        lightname = light['Name'].lower()
-        if lightname in text:
-            idx = light['idx']
-            type = light['idx'].lower() # `is` will fail as type is unicode type
-            status = light['Status'].lower() # `is` will fail as type is unicode type
-            if DEBUG: print 'name: %s, idx: %s, type: %s, status: %s' % (name, idx, type, status)
-            for command in ['on', 'off', 'toggle']:
-                if command in text:
-                    if command == status:
-                        return "The %s light is already %s" % (lightname, command)
+        lightname = light.name
+        idx = light['idx']
+        type = light.type
+        status = registry.get_state(('light', idx))
+        if DEBUG: print 'name: %s, idx: %s, type: %s, status: %s' % (lightname, idx, type, status)
+        for command in ['on', 'off', 'toggle']:
+            if command in text:
+                if command == status:
+                    return "The %s light is already %s" % (lightname, command)
+                else:
+                    client.send_light_command(idx, command, report_failure)
+                    if command == 'toggle':
+                        return 'Toggling light'
                     else:
-                        send_light_command(idx, command)
-                        if command is 'toggle':
-                            return 'Toggling light'
-                        else:
-                            return 'Turning %s light %s' % (lightname, command)
-            return 'I cannot execute that %s command' % type
-        return None
+                        return 'Turning %s light %s' % (lightname, command)
+        return 'I cannot execute that %s command' % type
 
     def handle_lights():
         """
             Wrapper function for `light` commands
-            
-            To-do: 
-            performace  -- Improve by moving `get_devices()` out of handle call.
-                           Alternatively, make `lights` global and have a function periodically update `lights`.
         """
-        lights = get_lights()
+        lights = client.get_lights()
         if lights:
-            for light in lights:
-                response = handle_light(light)
-                if response: return response
-            return 'That specific light is not defined'
+            if 'all' in text:
+                rooms, ambiguous = find_entities(['plan'])
+                if ambiguous:
+                    return 'There is more than one room called %s' % ambiguous
+                if rooms:
+                    return handle_room_lights(rooms[0][1])
+                location = spoken_location()
+                if location:
+                    return 'The %s room is not defined' % location
+                return handle_batch([(('light', light['idx']), light) for light in lights])
+            found, ambiguous = find_entities(['light'])
+            if ambiguous:
+                return 'There is more than one light called %s' % ambiguous
+            if not found:
+                return 'That specific light is not defined'
+            if len(found) > 1:
+                return handle_batch(found)
+            return handle_light(found[0][1])
         else:
             return 'There are no lights defined'
 
-    def handle_thermostat(thermostat):
+    def spoken_location():
+        """
+            Returns:
+            The words after the last `in` that do not name the whole house
+            or a server, e.g. `dining` for `turn off all the lights in the
+            dining`, or None if there are none
+        """
+        if 'in' not in text:
+            return None
+        servers = set(word for name in getattr(client, 'members', ()) for word in tokenize(name))
+        words = [word for word in text[len(text) - text[::-1].index('in'):]
+                 if word not in COMMON_WORDS and word not in KEYWORDS and word not in servers]
+        if not words or EVERYWHERE.intersection(words):
+            return None
+        return ' '.join(words)
+
+    def handle_room_lights(room):
+        """
+            Contains the logic to switch all lights in a room.
+
+            Usage:
+            'Turn off all lights in the living room'
+
+            Arguments:
+            room -- entity of the room
+
+            Returns:
+            A single response for the combined `light` commands
+        """
+        def room_lights():
+            lights = [(key, registry.get(key)) for key in registry.get_room_members(room['idx'])
+                      if key[0] == 'light']
+            return [(key, light) for key, light in lights if light is not None]
+
+        lights = room_lights()
+        if not lights:
+            registry.refresh_room(room['idx'])
+            lights = room_lights()
+        if not lights:
+            return 'There are no lights in the %s' % room.name
+        return handle_batch(lights, room.name)
+
+    def handle_batch(lights, roomname=None):
+        """
+            Contains the logic to switch several lights with one command.
+            Lights that are already in the requested state are skipped and
+            the others are switched concurrently.
+
+            Usage:
+            'Turn off all lights'
+            'Turn off the kitchen and hallway lights'
+            'Turn off all lights in the living room'
+
+            Arguments:
+            lights -- list of (key, entity) of lights to switch
+            roomname -- name of the room the lights are in, if any
+
+            Returns:
+            A single response for the combined `light` commands
+        """
+        def describe(lights):
+            names = [light.name for key, light in lights]
+            if len(names) > 3:
+                return '%s lights' % len(names)
+            return 'the %s light%s' % (join_names(names), 's' if len(names) > 1 else '')
+
+        where = ' in the %s' % roomname if roomname else ''
+        for command in ['on', 'off', 'toggle']:
+            if command in text:
+                break
+        else:
+            return 'I cannot execute that command for %s%s' % (describe(lights), where)
+        pending = [(key, light) for key, light in lights
+                   if command == 'toggle' or registry.get_state(key) != command]
+        if not pending:
+            response = '%s%s %s already %s' % (describe(lights), where,
+                                                'is' if len(lights) == 1 else 'are', command)
+            return response[0].upper() + response[1:]
+        errors = client.send_batch_command([key for key, light in pending], command, report_failure)
+        switched = [target for target, error in zip(pending, errors) if not error]
+        failed = [target for target, error in zip(pending, errors) if error]
+        if not switched:
+            return 'I could not switch %s%s' % (describe(failed), where)
+        if command == 'toggle':
+            response = 'Toggling %s%s' % (describe(switched), where)
+        else:
+            response = 'Turning %s %s%s' % (command, describe(switched), where)
+        if failed:
+            response += ', but I could not switch %s' % describe(failed)
+        return response
+
+    def handle_thermostat(thermostat, zone=None):
         """
             Contains the logic to handle the thermostat.
             Thermostat can be used to set or get temperature related settings.
@@ -411,46 +3104,65 @@ def handle(text, mic, profile):
             Usage: 
             'Increase/decrease the temperature'
             'What is the temperature and humidity?'
-            'What is the temperature in the living room?'
+            'Increase the temperature in the bedroom'
 
             To-do:
             implement -- home/away setting for thermostat
                       -- other thermostats beside Nest?
 
+            Arguments:
+            thermostat -- entity of the thermostat joined with its setpoint
+            zone -- name of the zone of the thermostat, if any
+
             Returns:
             The result of a `thermostat` command issued to Domoticz through Jasper
             
         """
         thermostatname = thermostat['Name']
-        setpoint = thermostat['SetPoint']
-        idx = thermostat['SetPointIdx']
+        where = 'in the %s' % zone if zone else 'inside the house'
+        if any(word in text for word in ["up", "increase", "down", "decrease"]):
+            if 'SetPointIdx' not in thermostat:
+                return "The %s thermostat has no setpoint." % thermostatname
+            setpoint = thermostat['SetPoint']
+            idx = thermostat['SetPointIdx']
         if any(word in text for word in ["up", "increase"]):
             sp = str(float(setpoint) + 1)
-            send_thermostat_command(idx, sp)
-            return "Increasing the temperature to %s." % sp
+            client.send_thermostat_command(idx, sp, report_failure)
+            return "Increasing the temperature %s to %s." % (where, sp)
         elif any(word in text for word in ["down", "decrease"]):
             sp = str(float(setpoint) - 1)
-            send_thermostat_command(idx, sp)
-            return "Decreasing the temperature to %s." % sp
+            client.send_thermostat_command(idx, sp, report_failure)
+            return "Decreasing the temperature %s to %s." % (where, sp)
         elif any(word in text for word in ["what", "is", "temperature", "humidity"]):
-            temp, humid = str(round(thermostat['Temp'],1)), str(thermostat['Humidity'])
-            return "Inside the house, it is %s degrees celsius and %s percent humidity." % (temp, humid)
+            temp = str(round(thermostat['Temp'],1))
+            if 'Humidity' not in thermostat:
+                return "%s, it is %s degrees celsius." % (where.capitalize(), temp)
+            humid = str(thermostat['Humidity'])
+            return "%s, it is %s degrees celsius and %s percent humidity." % (where.capitalize(), temp, humid)
         else:
             return "I did not understand your thermostat command."
 
     def handle_thermostats():
         """
-            Wrapper function for thermostat commands
-            
-            To-do: 
-            implement -- multiple thermostat
+            Wrapper function for thermostat commands. A thermostat is
+            selected by zone or by name and defaults to the first
+            thermostat with a setpoint.
         """
-        thermostats = get_thermostats()
+        thermostats = client.get_thermostats()
         if thermostats:
-            for thermostat in thermostats:
-                response = handle_thermostat(thermostat)
-                if response: return response
-            return 'That specific thermostat is not defined'
+            found, ambiguous = find_entities(['zone', 'temp'])
+            if ambiguous:
+                return 'There is more than one thermostat called %s' % ambiguous
+            if not found:
+                with_setpoint = [thermostat for thermostat in thermostats if 'SetPointIdx' in thermostat]
+                return handle_thermostat((with_setpoint or thermostats)[0])
+            (kind, idx), entity = found[0]
+            if kind == 'zone':
+                thermostat = registry.get_thermostat(entity['Thermostat'])
+                if thermostat is None:
+                    return 'The thermostat of the %s is not defined' % idx
+                return handle_thermostat(thermostat, idx)
+            return handle_thermostat(registry.get_thermostat(idx))
         else:
             return 'There are no thermostats defined'                     
                      
@@ -465,48 +3177,44 @@ def handle(text, mic, profile):
             'Deactivate the test group'
 
             Arguments:
-            scene -- json object for scene
+            scene -- entity of the scene
 
             Returns:
             The result of a `scene` command issued to Domoticz through Jasper
         """
-        scenename = scene['Name'].lower()
-        if scenename in text:
-            idx = scene['idx']
-            type = scene['Type'].lower()
-            status = scene['Status'].lower()
-            if DEBUG: print 'name: %s, idx: %s, type: %s, status: %s' % (scenename, idx, type, status)
-            for command in ['on', 'off', 'activate', 'deactivate']:
-                if command in text:
-                    if type == 'scene': 
-                        if command in ['on', 'activate']:
-                            send_scene_command(idx, 'on')
-                            return 'Activating the %s %s' % (scenename, type)
-                        else:
-                            return 'I can only activate scenes.'
-                    elif type == 'group':
-                        command = 'on' if command in ['on', 'activate'] else 'off' 
-                        send_scene_command(idx, command)
-                        return 'Switching %s the %s %s' % (command, scenename, type)
+        scenename = scene.name
+        idx = scene['idx']
+        type = scene.type
+        status = registry.get_state(('scene', idx))
+        if DEBUG: print 'name: %s, idx: %s, type: %s, status: %s' % (scenename, idx, type, status)
+        for command in ['on', 'off', 'activate', 'deactivate']:
+            if command in text:
+                if type == 'scene': 
+                    if command in ['on', 'activate']:
+                        client.send_scene_command(idx, 'on', report_failure)
+                        return 'Activating the %s %s' % (scenename, type)
                     else:
-                        return 'I cannot control %s types' % type
-            return 'I cannot execute that %s command' % type
-        return None
+                        return 'I can only activate scenes.'
+                elif type == 'group':
+                    command = 'on' if command in ['on', 'activate'] else 'off' 
+                    client.send_scene_command(idx, command, report_failure)
+                    return 'Switching %s the %s %s' % (command, scenename, type)
+                else:
+                    return 'I cannot control %s types' % type
+        return 'I cannot execute that %s command' % type
 
     def handle_scenes():
         """
             Wrapper function for scene commands
-
-            To-do: 
-            performance  -- Improve by moving `get_scenes()` out of handle call.
-                            Alternatively, make `scenes` global and have a function periodically update `scenes`.
         """
-        scenes = get_scenes()
+        scenes = registry.get_scenes()
         if scenes:
-            for scene in scenes:
-                response = handle_scene(scene)
-                if response: return response
-            return 'That specific scene or group is not defined'
+            found, ambiguous = find_entities(['scene'])
+            if ambiguous:
+                return 'There is more than one scene or group called %s' % ambiguous
+            if not found:
+                return 'That specific scene or group is not defined'
+            return handle_scene(found[0][1])
         else:
             return 'There are no scenes or groups defined'                     
                      
@@ -519,71 +3227,134 @@ def handle(text, mic, profile):
             Usage:
 
             To-do: 
-            performance -- `get_devices_in_room()` is probably relatively costly.
             floorplans -- implement if requested
 
             Arguments:
-            room - json object of room
+            room - entity of the room
 
             Returns:
             The result of a command issued to Domoticz through Jasper
         """
-        roomname = room['Name'].lower()
-        if roomname in text:
-            idx = room['idx']
-            devices = get_devices_in_room(idx)
-            if DEBUG: print 'roomname: %s, idx: %s, no. of devices in room: %s' % (roomname, idx, len(devices))
-            for device in devices:
-                devname = device['Name'].lower()
-                if devname in text:
-                    idx = device['idx'].lower()
-                    status = device['Status'].lower()
-                    if DEBUG: print 'devname: %s, idx: %s, status: %s' % (devname, idx, status)
-                    for command in ['on', 'off', 'toggle']:
-                        if command in text:
-                            if command == status:
-                                return 'The %s device in the %s is already turned %s' % (devname, roomname, command)
-                            else:
-                                return 'Turning %s the %s device in the %s' % (command, devname, roomname)
-                    return 'That command is undefined for device %s in the %s' % (devname, roomname)
+        roomname = room.name
+        idx = room['idx']
+        members = registry.get_room_members(idx)
+        if DEBUG: print 'roomname: %s, idx: %s, no. of devices in room: %s' % (roomname, idx, len(members))
+        if 'all' in text:
+            return handle_room_lights(room)
+        # Only lights and scenes/groups can be switched
+        found, ambiguous = find_entities(['light', 'scene'], members)
+        if not found and not ambiguous:
+            # The device may have been added to the room since the last reload
+            registry.refresh_room(idx)
+            members = registry.get_room_members(idx)
+            found, ambiguous = find_entities(['light', 'scene'], members)
+        if ambiguous:
+            return 'There is more than one device called %s in the %s' % (ambiguous, roomname)
+        if not found:
             return 'That device is not defined in the %s' % roomname
-        return None
+        if len(found) > 1:
+            lights = [(key, device) for key, device in found if key[0] == 'light']
+            if len(lights) == len(found):
+                return handle_batch(lights, roomname)
+            return 'I can only switch several lights at once'
+        (kind, idx), device = found[0]
+        devname = device.name
+        status = registry.get_state((kind, idx))
+        if DEBUG: print 'devname: %s, idx: %s, status: %s' % (devname, idx, status)
+        for command in ['on', 'off', 'toggle']:
+            if command in text:
+                if command == status:
+                    return 'The %s device in the %s is already turned %s' % (devname, roomname, command)
+                elif kind == 'scene':
+                    client.send_scene_command(idx, 'off' if command == 'off' else 'on', report_failure)
+                else:
+                    client.send_light_command(idx, command, report_failure)
+                return 'Turning %s the %s device in the %s' % (command, devname, roomname)
+        return 'That command is undefined for device %s in the %s' % (devname, roomname)
+
+    def handle_whereabouts():
+        """
+            Contains the logic to tell which rooms a device is in.
+
+            Usage:
+            'Which room is the test light in?'
+
+            Returns:
+            The rooms of the device named in the text
+        """
+        found, ambiguous = find_entities(DEVICE_FILTERS + ['scene'])
+        if ambiguous:
+            return 'There is more than one device called %s' % ambiguous
+        if not found:
+            return 'That device is not defined'
+        key, device = found[0]
+        rooms = [room.name for room in registry.get_rooms_of(key)]
+        if not rooms:
+            return 'The %s is not in any room' % device.name
+        return 'The %s is in the %s' % (device.name, join_names(rooms))
 
     def handle_rooms():
         """
             Wrapper function for room commands
-
-            To-do: 
-            performance -- Improve by moving `get_rooms()` out of handle call.
-                           Alternatively, make `rooms` etc. global and have a function periodically update `rooms` etc. 
         """
-        rooms = get_rooms()
+        rooms = registry.get_rooms()
         if rooms:
-            for room in rooms:
-                response = handle_room(room)
-                if response: return response
-            return 'That specific room is not defined.'
+            if any(word in text for word in ["which", "what"]):
+                return handle_whereabouts()
+            found, ambiguous = find_entities(['plan'])
+            if ambiguous:
+                return 'There is more than one room called %s.' % ambiguous
+            if not found:
+                return 'That specific room is not defined.'
+            return handle_room(found[0][1])
         else:
             return 'There are no rooms defined.'
 
-    text = text.lower().split()
-    if any(word in text for word in ["room"]):
-        response = handle_rooms()
-    elif any(word in text for word in ["scene", "group", "mode"]):
-        response = handle_scenes()
-    elif any(word in text for word in ["light", "lights"]):
-        response = handle_lights()
-    elif any(word in text for word in ["temperature", "humidity", "thermostat"]):
-        response = handle_thermostats()
-    else:
-        response = 'Your command is not defined in Domoticz'
+    start = time.time()
+    utterance = text
+    client = get_client(profile)
+    registry = client.registry
+    try:
+        with timings.measure('refresh'):
+            registry.ensure_fresh()
+        with timings.measure('route'):
+            text = tokenize(text)
+            handler = {'room': handle_rooms, 'scene': handle_scenes, 'light': handle_lights,
+                       'thermostat': handle_thermostats}.get(route(text, [registry]))
+        with timings.measure('respond'):
+            if handler:
+                response = handler()
+            else:
+                response = 'Your command is not defined in Domoticz'
+    except UnreachableError:
+        logger.warning('Domoticz is unreachable', exc_info=True)
+        response = 'Sorry, Domoticz is unreachable'
+    except (RuntimeError, urllib2.HTTPError):
+        logger.warning('Domoticz failed to execute a command', exc_info=True)
+        response = 'Sorry, Domoticz could not execute that command'
+    timings.record('handle', time.time() - start)
     mic.say(response)
+    if client.audit:
+        client.audit.record('Jasper: "%s" -> "%s"' % (utterance, response))
+    if profile['domoticz'].get('timings'):
+        timings.dump(profile['domoticz']['timings'])
 
 def isValid(text):
     """
-        Returns True if the input is related to home automation.
+        Returns True if the input is related to home automation, i.e. it
+        contains a keyword or the name of an entity known to a client.
+        Before the first command the client is created from the Jasper
+        profile, so commands that only name an entity work from the start.
 
         Arguments:
         text -- user-input, typically transcribed speech
     """
-    return bool(re.search(r'\b(room|scene|group|mode|light|thermostat|temperature|humidity)\b', text, re.IGNORECASE))
+    if not _clients:
+        profile = load_profile()
+        if profile and 'domoticz' in profile:
+            try:
+                get_client(profile).registry.ensure_fresh()
+            except Exception:
+                logger.warning('Loading the Domoticz registry failed', exc_info=True)
+    registries = [client.registry for client in _clients.values()]
+    return route(tokenize(text), registries) is not None
@@ -0,0 +1,84 @@
+# -*- coding: utf-8-*-
+"""
+    Declarative provisioning for the Domoticz plugin for Jasper
+
+    Reads the desired rooms, scenes/groups, scene devices and scene timers
+    from a file and creates or deletes only what differs from the Domoticz
+    server in the Jasper profile, so running it again for an unchanged file
+    only reads the current state.
+
+    Usage:
+    python provision.py ~/.jasper/profile.yml state.yml --dry-run
+
+    The desired state, in yaml or json:
+    rooms: [Living, Kitchen]
+    scenes:
+      - name: Movie
+        devices:
+          - {device: 12, command: off}
+          - {device: 14, level: 30}
+        timers:
+          - {type: 2, time: '20:30', days: 128}
+      - name: Downstairs
+        group: true
+        devices:
+          - {device: 12}
+"""
+import sys
+import logging
+import argparse
+
+import yaml
+
+import domoticz
+
+def load(path):
+    """
+        Loads a yaml or json file
+
+        Returns:
+        The decoded contents
+    """
+    with open(path) as f:
+        return yaml.safe_load(f) or {}
+
+def get_provisioned_client(profile, server=None):
+    """
+        Returns a client for the Domoticz server in profile, or for the
+        server named `server` if the profile lists several `servers`
+    """
+    if 'servers' not in profile['domoticz']:
+        return domoticz.DomoticzClient(profile)
+    client = domoticz.FederatedClient(profile)
+    if server not in client.members:
+        raise RuntimeError('Choose one of the Domoticz servers %s with --server' % ', '.join(client.members))
+    return client.members[server]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Provision rooms, scenes and scene timers in Domoticz')
+    parser.add_argument('profile', help='Jasper profile with the domoticz settings')
+    parser.add_argument('state', help='yaml or json file with the desired state')
+    parser.add_argument('--server', help='name of the server to provision if the profile lists several')
+    parser.add_argument('--prune', action='store_true',
+                        help='delete rooms and scenes that are not in the desired state')
+    parser.add_argument('--dry-run', action='store_true', help='only list the changes')
+    args = parser.parse_args(argv)
+    logging.basicConfig()
+
+    client = get_provisioned_client(load(args.profile), args.server)
+    try:
+        changes = client.provision(load(args.state), args.prune, args.dry_run)
+    finally:
+        client.close()
+    failed = 0
+    for change, error in changes:
+        if error:
+            failed += 1
+            print '%s failed: %s' % (change, error)
+        else:
+            print change
+    print '%s changes, %s failed' % (len(changes), failed)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,760 @@
+# -*- coding: utf-8-*-
+"""
+    Tests for the Domoticz plugin for Jasper
+
+    The commands are handled against the stand-in for the Domoticz JSON API
+    of the benchmark, so no Domoticz server is needed.
+
+    Usage:
+    python -m unittest test_domoticz
+"""
+import os
+import json
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+import StringIO
+
+import benchmark
+import domoticz
+
+class StandInTestCase(unittest.TestCase):
+    """
+        Serves an installation of `size` devices from the stand-in server
+        and handles commands with a client of its own
+    """
+    size = 30
+    ttl = 3600
+
+    def setUp(self):
+        self.installation = benchmark.Installation(self.size)
+        self.customize(self.installation)
+        self.server = benchmark.start_server(self.installation, 0)
+        self.url = 'http://127.0.0.1:%s' % self.server.server_port
+        self.profile = {'domoticz': {'server': self.url, 'username': 'test', 'password': 'test',
+                                     'ttl': self.ttl}}
+        self.configure(self.profile['domoticz'])
+        self.mic = benchmark.Mic()
+        self.client = domoticz.get_client(self.profile)
+        self.registry = self.client.registry
+        self.registry.ensure_fresh()
+
+    def tearDown(self):
+        self.client.close()
+        del domoticz._clients[self.url]
+        self.server.shutdown()
+        self.server.server_close()
+
+    def customize(self, installation):
+        pass
+
+    def configure(self, settings):
+        pass
+
+    def handle(self, text):
+        domoticz.handle(text, self.mic, self.profile)
+        return self.mic.said[-1]
+
+    def light(self, name):
+        return [light for light in self.installation.lights if light['Name'] == name][0]
+
+class HandleTest(StandInTestCase):
+    def test_all_lights_in_a_named_room(self):
+        study = ['Study ceiling 7', 'Study wall 17', 'Study desk 27']
+        for light in self.installation.lights:
+            light['Status'] = 'On'
+        self.registry.reload()
+        response = self.handle('turn off all the lights in the study')
+        self.assertTrue(response.startswith('Turning off'), response)
+        self.assertTrue(response.endswith('in the study'), response)
+        for light in self.installation.lights:
+            self.assertEqual(light['Status'], 'Off' if light['Name'] in study else 'On', light['Name'])
+
+    def test_all_lights_without_a_room(self):
+        self.handle('turn on all lights')
+        self.assertTrue(all(light['Status'] == 'On' for light in self.installation.lights))
+
+    def test_all_lights_in_an_unknown_room(self):
+        statuses = [light['Status'] for light in self.installation.lights]
+        response = self.handle('turn off all the lights in the dining')
+        self.assertEqual(response, 'The dining room is not defined')
+        self.assertEqual([light['Status'] for light in self.installation.lights], statuses)
+
+    def test_all_lights_in_the_house(self):
+        self.handle('turn on all lights in the house')
+        self.assertTrue(all(light['Status'] == 'On' for light in self.installation.lights))
+
+    def test_room_command_does_not_switch_thermometers(self):
+        response = self.handle('turn on the cellar thermostat 10 in the cellar room')
+        self.assertEqual(response, 'That device is not defined in the cellar')
+
+    def test_room_members_are_refreshed_on_a_miss(self):
+        self.installation.lights.append({'idx': '100', 'Name': 'Lava lamp', 'Status': 'Off',
+                                         'Type': 'Light/Switch', 'HardwareName': 'Z-Wave'})
+        self.installation.updated[('device', '100')] = time.time()
+        self.registry.sync()
+        self.installation.plan_devices['1'].append({'idx': '100', 'devidx': '100', 'type': 0,
+                                                    'Name': 'Lava lamp'})
+        response = self.handle('turn on the lava lamp in the kitchen room')
+        self.assertEqual(response, 'Turning on the lava lamp device in the kitchen')
+        self.assertEqual(self.light('Lava lamp')['Status'], 'On')
+
+    def test_command_is_written_through(self):
+        self.light('Kitchen ceiling 1')['Status'] = 'Off'
+        self.registry.reload()
+        self.handle('turn on the kitchen ceiling 1 light')
+        self.assertEqual(self.registry.get(('light', '1')).state, 'on')
+        self.assertEqual(self.handle('turn on the kitchen ceiling 1 light'),
+                         'The kitchen ceiling 1 light is already on')
+
+class FederatedTestCase(unittest.TestCase):
+    """
+        Serves an installation of `size` devices from a stand-in server per
+        name in `servers` and handles commands with a federated client
+    """
+    size = 30
+    servers = ['main', 'annex']
+
+    def setUp(self):
+        self.installations, self.stand_ins = {}, []
+        members = []
+        for name in self.servers:
+            installation = benchmark.Installation(self.size)
+            server = benchmark.start_server(installation, 0)
+            self.installations[name] = installation
+            self.stand_ins.append(server)
+            members.append({'name': name, 'server': 'http://127.0.0.1:%s' % server.server_port})
+        self.profile = {'domoticz': {'username': 'test', 'password': 'test', 'ttl': 3600,
+                                     'servers': members}}
+        self.customize(self.profile['domoticz'])
+        self.mic = benchmark.Mic()
+        self.client = domoticz.get_client(self.profile)
+        self.registry = self.client.registry
+        self.registry.ensure_fresh()
+
+    def tearDown(self):
+        self.client.close()
+        del domoticz._clients[tuple(member['server'] for member in self.profile['domoticz']['servers'])]
+        for server in self.stand_ins:
+            server.shutdown()
+            server.server_close()
+
+    def customize(self, settings):
+        pass
+
+    def handle(self, text):
+        domoticz.handle(text, self.mic, self.profile)
+        return self.mic.said[-1]
+
+class FederatedRoomTest(FederatedTestCase):
+    def test_room_members_are_refreshed_on_a_miss(self):
+        annex = self.installations['annex']
+        annex.lights.append({'idx': '100', 'Name': 'Lava lamp', 'Status': 'Off',
+                             'Type': 'Light/Switch', 'HardwareName': 'Z-Wave'})
+        annex.updated[('device', '100')] = time.time()
+        self.client.members['annex'].registry.sync()
+        annex.plan_devices['1'].append({'idx': '100', 'devidx': '100', 'type': 0, 'Name': 'Lava lamp'})
+        response = self.handle('turn on the lava lamp in the kitchen room in the annex')
+        self.assertEqual(response, 'Turning on the lava lamp device in the kitchen')
+        self.assertEqual(annex.lights[-1]['Status'], 'On')
+
+class FederatedTest(FederatedTestCase):
+    def customize(self, settings):
+        settings['servers'][1]['zones'] = {'bedroom': {'temp': 20}}
+
+    def test_command_goes_to_the_owner(self):
+        main = [light['Status'] for light in self.installations['main'].lights]
+        self.light('annex', 'Kitchen ceiling 1')['Status'] = 'Off'
+        self.client.members['annex'].registry.reload()
+        response = self.handle('turn on the kitchen ceiling 1 light in the annex')
+        self.assertEqual(response, 'Turning kitchen ceiling 1 light on')
+        self.assertEqual(self.light('annex', 'Kitchen ceiling 1')['Status'], 'On')
+        self.assertEqual([light['Status'] for light in self.installations['main'].lights], main)
+
+    def test_zone_of_a_server(self):
+        response = self.handle('increase the temperature in the bedroom')
+        self.assertEqual(response, 'Increasing the temperature in the bedroom to 20.7.')
+        self.assertEqual(self.installations['annex'].setpoints[1]['SetPoint'], '20.7')
+        self.assertEqual(self.installations['main'].setpoints[1]['SetPoint'], '19.7')
+
+    def test_zones_outside_the_servers_are_refused(self):
+        profile = {'domoticz': dict(self.profile['domoticz'], zones={'bedroom': {'temp': 20}})}
+        self.assertRaises(RuntimeError, domoticz.FederatedClient, profile)
+
+    def light(self, server, name):
+        return [light for light in self.installations[server].lights if light['Name'] == name][0]
+
+class FederatedDownTest(FederatedTestCase):
+    def customize(self, settings):
+        settings['servers'].append({'name': 'attic', 'server': 'http://127.0.0.1:1', 'retries': 0})
+
+    def test_server_that_is_down_is_skipped(self):
+        self.assertEqual(self.client.members['attic'].registry.synced, None)
+        response = self.handle('turn on all lights in the main')
+        self.assertTrue(response.startswith('Turning on'), response)
+        self.assertTrue(all(light['Status'] == 'On' for light in self.installations['main'].lights))
+
+class InvalidResponseTest(StandInTestCase):
+    def respond_with(self, body, **match):
+        # Answers the requests with the given query fields with `body`
+        respond = self.installation.respond
+
+        def proxy(query):
+            if all(query.get(field) == value for field, value in match.items()):
+                return body
+            return respond(query)
+        self.installation.respond = proxy
+
+    def test_command_with_html_response(self):
+        self.respond_with('<html><body>502 Bad Gateway</body></html>', param='switchlight')
+        self.assertEqual(self.handle('turn on the kitchen ceiling 1 light'),
+                         'Sorry, Domoticz could not execute that command')
+
+    def test_refresh_with_html_response(self):
+        self.respond_with('<html><body>502 Bad Gateway</body></html>', type='devices')
+        self.assertRaises(RuntimeError, self.registry.reload)
+
+    def test_refresh_with_truncated_response(self):
+        self.respond_with('{"status": "OK", "result": [{"idx": "1", "Na', type='scenes')
+        self.assertRaises(RuntimeError, self.registry.reload)
+
+    def test_response_without_status(self):
+        self.respond_with('[]', param='switchlight')
+        self.assertEqual(self.handle('turn on the kitchen ceiling 1 light'),
+                         'Sorry, Domoticz could not execute that command')
+
+class ConfirmationTest(StandInTestCase):
+    def setUp(self):
+        StandInTestCase.setUp(self)
+        self.confirm_delay = domoticz.CONFIRM_DELAY
+        domoticz.CONFIRM_DELAY = 0.2
+        self.requests = []
+        respond = self.installation.respond
+
+        def record(query):
+            self.requests.append(query)
+            return respond(query)
+        self.installation.respond = record
+
+    def tearDown(self):
+        domoticz.CONFIRM_DELAY = self.confirm_delay
+        StandInTestCase.tearDown(self)
+
+    def test_commands_are_confirmed_by_one_sync(self):
+        for light in self.installation.lights:
+            light['Status'] = 'Off'
+        self.registry.reload()
+        del self.requests[:]
+        self.handle('turn on all lights')
+        time.sleep(0.5)
+        reads = [query for query in self.requests if query.get('type') != 'command']
+        self.assertEqual(len(reads), len(domoticz.DEVICE_FILTERS) + 1)
+        self.assertTrue(all('lastupdate' in query for query in reads))
+        self.assertEqual(self.registry.pending, {})
+        self.assertTrue(all(light.state == 'on' for light in self.registry.get_devices('light')))
+
+class AsyncTest(StandInTestCase):
+    def customize(self, installation):
+        for light in installation.lights:
+            light['Status'] = 'Off'
+
+    def configure(self, settings):
+        settings['async'] = True
+
+    def test_failed_command_is_reported_and_reverted(self):
+        respond = self.installation.respond
+
+        def fail_switch(query):
+            if query.get('param') == 'switchlight':
+                return '{"status": "ERR"}'
+            return respond(query)
+        self.installation.respond = fail_switch
+        response = self.handle('turn on the kitchen ceiling 1 light')
+        self.assertEqual(response, 'Turning kitchen ceiling 1 light on')
+        self.client.worker.join()
+        self.assertEqual(self.mic.said[-1], 'Sorry, the command for the kitchen ceiling 1 failed')
+        self.assertEqual(self.registry.pending, {})
+        self.assertEqual(self.registry.get(('light', '1')).state, 'off')
+
+    def test_commands_are_sent_in_order(self):
+        self.handle('turn on the kitchen ceiling 1 light')
+        self.handle('turn off the kitchen ceiling 1 light')
+        self.handle('toggle the kitchen ceiling 1 light')
+        self.client.worker.join()
+        self.assertEqual(self.light('Kitchen ceiling 1')['Status'], 'On')
+
+class ThermostatTest(StandInTestCase):
+    def customize(self, installation):
+        installation.setpoints.append({'idx': '99', 'Name': 'Attic heating setpoint', 'SetPoint': '18.0',
+                                       'HardwareName': 'Thermostat 20', 'Type': 'Thermostat',
+                                       'LastUpdate': ''})
+        installation.setpoints.append({'idx': '98', 'Name': 'Boiler setpoint', 'SetPoint': '55.0',
+                                       'HardwareName': 'Boiler', 'Type': 'Thermostat',
+                                       'LastUpdate': ''})
+        del installation.setpoints[2]
+
+    def configure(self, settings):
+        settings['zones'] = {'bedroom': {'temp': 10, 'setpoint': 98}, 'attic': {'temp': 20}}
+
+    def setpoint(self, idx):
+        return [setpoint for setpoint in self.installation.setpoints if setpoint['idx'] == idx][0]
+
+    def test_setpoint_on_the_same_hardware(self):
+        thermostat = self.registry.get_thermostat('20')
+        self.assertEqual((thermostat['SetPointIdx'], thermostat['SetPoint']), ('50', '19.7'))
+
+    def test_thermostat_without_setpoint(self):
+        self.assertNotIn('SetPointIdx', self.registry.get_thermostat('30'))
+        self.assertEqual(self.handle('increase the temperature of the cellar thermostat 30'),
+                         'The Cellar thermostat 30 thermostat has no setpoint.')
+
+    def test_zone_overrides_the_setpoint(self):
+        self.assertEqual(self.registry.get_thermostat('10')['SetPointIdx'], '98')
+        self.assertEqual(self.handle('increase the temperature in the bedroom'),
+                         'Increasing the temperature in the bedroom to 56.0.')
+        self.assertEqual(self.setpoint('98')['SetPoint'], '56.0')
+        self.assertEqual(self.setpoint('40')['SetPoint'], '19.0')
+
+    def test_zone_uses_the_joined_setpoint(self):
+        self.assertEqual(self.handle('decrease the temperature in the attic'),
+                         'Decreasing the temperature in the attic to 18.7.')
+        self.assertEqual(self.setpoint('50')['SetPoint'], '18.7')
+
+    def test_temperature_inside_the_house(self):
+        self.assertEqual(self.handle('what is the temperature'),
+                         'Inside the house, it is 19.7 degrees celsius and 67 percent humidity.')
+
+class EventTest(StandInTestCase):
+    def test_switch_event(self):
+        self.registry.apply_event({'idx': 1, 'name': 'Kitchen ceiling 1', 'dtype': 'Light/Switch',
+                                   'switchType': 'On/Off', 'nvalue': 1})
+        self.assertEqual(self.registry.get(('light', '1')).state, 'on')
+        self.registry.apply_event({'idx': 1, 'name': 'Kitchen ceiling 1', 'dtype': 'Light/Switch',
+                                   'switchType': 'On/Off', 'nvalue': 0})
+        self.assertEqual(self.registry.get(('light', '1')).state, 'off')
+
+    def test_renamed_device_is_found_by_its_new_name(self):
+        self.registry.apply_event({'idx': 1, 'name': 'Lava lamp', 'dtype': 'Light/Switch',
+                                   'switchType': 'On/Off', 'nvalue': 1})
+        self.assertEqual(self.handle('turn off the lava lamp'), 'Turning lava lamp light off')
+
+    def test_temperature_and_setpoint_events_update_the_thermostat(self):
+        self.registry.apply_event({'idx': 20, 'name': 'Cellar thermostat 20', 'dtype': 'Temp + Humidity',
+                                   'svalue1': '22.5', 'svalue2': '40'})
+        self.registry.apply_event({'idx': 50, 'name': 'Cellar setpoint 20', 'dtype': 'Thermostat',
+                                   'svalue1': '21.0'})
+        thermostat = self.registry.get_thermostat('20')
+        self.assertEqual((thermostat['Temp'], thermostat['Humidity'], thermostat['SetPoint']),
+                         (22.5, 40, '21.0'))
+
+    def test_event_of_unknown_device_is_ignored(self):
+        self.registry.apply_event({'idx': 999, 'name': 'Doorbell', 'dtype': 'Light/Switch',
+                                   'switchType': 'Doorbell', 'nvalue': 1})
+        self.assertEqual(self.registry.get(('light', '999')), None)
+
+class RoutingTest(StandInTestCase):
+    def customize(self, installation):
+        installation.lights.append({'idx': '100', 'Name': 'Kettle', 'Status': 'Off',
+                                    'Type': 'Light/Switch', 'HardwareName': 'Z-Wave'})
+        installation.lights.append({'idx': '101', 'Name': 'Front door', 'Status': 'Off',
+                                    'Type': 'Light/Switch', 'HardwareName': 'Z-Wave'})
+        installation.temps.append({'idx': '102', 'Name': 'Outside', 'Temp': 12.3,
+                                   'Type': 'Temp', 'HardwareName': 'Weather'})
+
+    def test_entity_name_with_an_action_is_valid(self):
+        self.assertTrue(domoticz.isValid('Turn on the kettle'))
+        self.assertEqual(self.handle('Turn on the kettle'), 'Turning kettle light on')
+
+    def test_entity_name_without_an_action_is_not_valid(self):
+        self.assertFalse(domoticz.isValid('what is the weather outside'))
+        self.assertFalse(domoticz.isValid('who is at the front door'))
+
+    def test_keywords_are_valid(self):
+        self.assertTrue(domoticz.isValid('what is the temperature outside'))
+
+class ProfileTest(StandInTestCase):
+    def setUp(self):
+        StandInTestCase.setUp(self)
+        self.client.close()
+        del domoticz._clients[self.url]
+        self.load_profile = domoticz.load_profile
+        domoticz.load_profile = lambda: self.profile
+
+    def tearDown(self):
+        domoticz.load_profile = self.load_profile
+        StandInTestCase.tearDown(self)
+
+    def test_entity_names_are_known_from_the_start(self):
+        self.assertTrue(domoticz.isValid('switch the kitchen ceiling 1 on'))
+        self.assertIn(self.url, domoticz._clients)
+
+class RefreshTest(StandInTestCase):
+    ttl = 60
+
+    def test_stale_registry_is_served_while_refreshing(self):
+        self.server.latency = 0.5
+        self.registry.updated = time.time() - self.ttl
+        start = time.time()
+        self.handle('what is the temperature')
+        self.assertLess(time.time() - start, 0.25)
+
+    def test_lookups_do_not_wait_for_a_refresh(self):
+        self.server.latency = 0.5
+        thread = threading.Thread(target=self.registry.reload)
+        thread.start()
+        time.sleep(0.1)
+        start = time.time()
+        domoticz.isValid('turn on the kitchen ceiling 1 light')
+        self.assertLess(time.time() - start, 0.25)
+        thread.join()
+
+    def test_rooms_are_fetched_concurrently(self):
+        # Serially the 5 lists and 10 rooms would take 1.5s
+        self.server.latency = 0.1
+        start = time.time()
+        self.registry.reload()
+        self.assertLess(time.time() - start, 1.0)
+
+class SnapshotTest(StandInTestCase):
+    def customize(self, installation):
+        for light in installation.lights:
+            light['Status'] = 'Off'
+
+    def configure(self, settings):
+        self.directory = tempfile.mkdtemp()
+        settings['snapshot'] = os.path.join(self.directory, 'registry.json')
+
+    def tearDown(self):
+        StandInTestCase.tearDown(self)
+        shutil.rmtree(self.directory)
+
+    def restart(self):
+        return domoticz.Registry(self.client, snapshot=self.profile['domoticz']['snapshot'])
+
+    def test_snapshot_round_trip(self):
+        registry = self.restart()
+        self.assertTrue(registry.load())
+        self.assertEqual(sorted(registry.entities), sorted(self.registry.entities))
+        self.assertEqual(registry.rooms.members, self.registry.rooms.members)
+        self.assertEqual(registry.get(('light', '1')).state, 'off')
+
+    def test_snapshot_of_another_server_is_ignored(self):
+        path = self.profile['domoticz']['snapshot']
+        with open(path) as f:
+            snapshot = json.load(f)
+        snapshot['server'] = 'http://elsewhere:8080'
+        with open(path, 'w') as f:
+            json.dump(snapshot, f)
+        self.assertFalse(self.restart().load())
+
+    def test_written_through_state_is_saved(self):
+        self.registry.write_through(('light', '1'), Status='On')
+        self.registry.refresh()
+        registry = self.restart()
+        registry.load()
+        self.assertEqual(registry.get(('light', '1')).state, 'on')
+
+    def test_loaded_state_is_not_trusted_until_revalidated(self):
+        registry = self.restart()
+        registry.load()
+        self.assertEqual(registry.get_state(('light', '1')), None)
+        registry.write_through(('light', '1'), Status='On')
+        self.assertEqual(registry.get_state(('light', '1')), 'on')
+        self.assertEqual(registry.get_state(('light', '11')), None)
+        registry.refresh()
+        self.assertEqual(registry.get_state(('light', '11')), 'off')
+
+    def test_command_is_sent_before_the_snapshot_is_revalidated(self):
+        self.light('Kitchen ceiling 1')['Status'] = 'On'
+        self.client.close()
+        del domoticz._clients[self.url]
+        revalidated = threading.Event()
+        respond = self.installation.respond
+
+        def delay_sync(query):
+            if 'lastupdate' in query:
+                revalidated.wait(5)
+            return respond(query)
+        self.installation.respond = delay_sync
+        try:
+            response = self.handle('turn off the kitchen ceiling 1 light')
+        finally:
+            revalidated.set()
+        self.client = domoticz._clients[self.url]
+        self.assertEqual(response, 'Turning kitchen ceiling 1 light off')
+        self.assertEqual(self.light('Kitchen ceiling 1')['Status'], 'Off')
+
+class StandInTest(StandInTestCase):
+    def test_unchanged_delta_sync(self):
+        self.assertFalse(self.registry.sync())
+
+    def test_delta_sync_after_a_command(self):
+        self.handle('toggle the kitchen ceiling 1 light')
+        self.assertTrue(self.registry.sync())
+        # `ActTime` is in seconds, so a change in the second of a sync comes
+        # again with the next one
+        time.sleep(1.1)
+        self.registry.sync()
+        self.assertFalse(self.registry.sync())
+
+    def test_toggle(self):
+        light = self.light('Kitchen ceiling 1')
+        status = light['Status']
+        self.installation.command({'param': 'switchlight', 'idx': light['idx'], 'switchcmd': 'Toggle'})
+        self.assertEqual(light['Status'], 'Off' if status == 'On' else 'On')
+
+class StreamingParserTest(unittest.TestCase):
+    records = [{'idx': '1', 'Name': u'Caf\xe9 {light}', 'Status': 'On', 'Level': 12.5},
+               {'idx': '2', 'Name': 'Quote " and ] bracket', 'Data': {'nested': [1, 2, {'a': None}]}},
+               {'idx': '3', 'Name': 'Last', 'Used': True}]
+
+    def parse(self, body, chunk_size, fields=None):
+        meta = {}
+        records = list(domoticz.iter_json_records(StringIO.StringIO(body), fields, meta, chunk_size))
+        return records, meta
+
+    def test_chunk_boundaries(self):
+        body = json.dumps({'status': 'OK', 'title': 'Devices', 'result': self.records, 'ActTime': 1234567})
+        for chunk_size in [1, 2, 3, 5, 7, 16, 64, len(body)]:
+            records, meta = self.parse(body, chunk_size)
+            self.assertEqual(records, self.records, chunk_size)
+            self.assertEqual(meta, {'status': 'OK', 'title': 'Devices', 'ActTime': 1234567}, chunk_size)
+
+    def test_fields(self):
+        body = json.dumps({'result': self.records, 'status': 'OK'})
+        records, meta = self.parse(body, 4, ('idx', 'Name'))
+        self.assertEqual(records, [{'idx': record['idx'], 'Name': record['Name']} for record in self.records])
+
+    def test_empty_and_missing_result(self):
+        self.assertEqual(self.parse('{"status": "OK", "result": []}', 3), ([], {'status': 'OK'}))
+        self.assertEqual(self.parse('{"status": "ERR"}', 3), ([], {'status': 'ERR'}))
+
+    def test_truncated_response(self):
+        body = json.dumps({'status': 'OK', 'result': self.records})[:-10]
+        self.assertRaises(ValueError, self.parse, body, 8)
+
+class PhraseIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = domoticz.PhraseIndex()
+        self.index.add(('light', '1'), 'Kitchen')
+        self.index.add(('light', '2'), 'Kitchen lamp')
+        self.index.add(('light', '3'), 'Dinnertable')
+        self.index.add(('scene', '1'), 'Kitchen')
+
+    def test_longest_names(self):
+        words = domoticz.tokenize('turn on the kitchen lamp and the kitchen')
+        self.assertEqual(self.index.match(words),
+                         [('kitchen lamp', [('light', '2')]),
+                          ('kitchen', [('light', '1'), ('scene', '1')])])
+
+    def test_accept(self):
+        words = domoticz.tokenize('activate the kitchen')
+        self.assertEqual(self.index.match(words, lambda key: key[0] == 'scene'), [('kitchen', [('scene', '1')])])
+
+    def test_rename_and_discard(self):
+        self.index.add(('light', '2'), 'Pantry')
+        self.index.discard(('light', '1'))
+        words = domoticz.tokenize('the kitchen lamp in the pantry')
+        self.assertEqual(self.index.match(words), [('kitchen', [('scene', '1')]), ('pantry', [('light', '2')])])
+
+    def test_similar_names(self):
+        words = domoticz.tokenize('turn on the dinner table light')
+        self.assertEqual(self.index.match_similar(words, domoticz.DEFAULT_FUZZY_THRESHOLD),
+                         [('dinner table', [('light', '3')])])
+        words = domoticz.tokenize('turn on the garage light')
+        self.assertEqual(self.index.match_similar(words, domoticz.DEFAULT_FUZZY_THRESHOLD), [])
+
+class SingleFlightTest(unittest.TestCase):
+    def test_concurrent_calls_are_coalesced(self):
+        flights = domoticz.SingleFlight()
+        calls = []
+
+        def fetch():
+            calls.append(None)
+            time.sleep(0.2)
+            return 'result'
+
+        results = domoticz.run_concurrently([lambda: flights.do('key', fetch)] * 8, 8)
+        self.assertEqual(results, [('result', None)] * 8)
+        self.assertEqual(len(calls), 1)
+
+    def test_errors_are_shared(self):
+        flights = domoticz.SingleFlight()
+
+        def fail():
+            time.sleep(0.2)
+            raise RuntimeError('failed')
+
+        results = domoticz.run_concurrently([lambda: flights.do('key', fail)] * 4, 4)
+        self.assertTrue(all(isinstance(error, RuntimeError) for result, error in results))
+        self.assertEqual(flights.do('key', lambda: 'again'), 'again')
+
+class EventFieldsTest(unittest.TestCase):
+    def test_switch(self):
+        self.assertEqual(domoticz.event_fields({'name': 'Lamp', 'dtype': 'Light/Switch',
+                                                'switchType': 'Dimmer', 'nvalue': 2}),
+                         {'Name': 'Lamp', 'Status': 'On'})
+        self.assertEqual(domoticz.event_fields({'switchType': 'On/Off', 'nvalue': 0}), {'Status': 'Off'})
+
+    def test_temperature(self):
+        self.assertEqual(domoticz.event_fields({'dtype': 'Temp', 'svalue1': '19.5'}), {'Temp': 19.5})
+        self.assertEqual(domoticz.event_fields({'dtype': 'Temp + Humidity', 'svalue1': '19.5', 'svalue2': '45'}),
+                         {'Temp': 19.5, 'Humidity': 45})
+
+    def test_setpoint(self):
+        self.assertEqual(domoticz.event_fields({'dtype': 'Setpoint', 'svalue1': '20.5'}), {'SetPoint': '20.5'})
+
+    def test_other_devices(self):
+        self.assertEqual(domoticz.event_fields({'dtype': 'P1 Smart Meter', 'svalue1': '1234'}), {})
+
+class CommandWorkerTest(unittest.TestCase):
+    def setUp(self):
+        self.worker = domoticz.CommandWorker(4, 8)
+
+    def test_commands_for_an_entity_are_sent_in_order(self):
+        sent = []
+        for i in range(50):
+            self.worker.submit(('light', '1'), lambda i=i: sent.append(i))
+        self.worker.join()
+        self.assertEqual(sent, range(50))
+
+    def test_failure_is_passed_to_on_error(self):
+        errors = []
+
+        def fail():
+            raise RuntimeError('failed')
+        self.worker.submit(('light', '1'), fail, errors.append)
+        self.worker.submit(('light', '1'), lambda: None, errors.append)
+        self.worker.join()
+        self.assertEqual([str(error) for error in errors], ['failed'])
+
+class ListSink(object):
+    # Keeps the written batches, writing blocks until `writable` is set
+    def __init__(self, error=None):
+        self.batches = []
+        self.error = error
+        self.writable = threading.Event()
+        self.writable.set()
+
+    def write(self, lines):
+        self.writable.wait(5)
+        if self.error:
+            raise self.error
+        self.batches.append(lines)
+
+    def close(self):
+        pass
+
+class AuditLogTest(unittest.TestCase):
+    def test_full_batch_is_written(self):
+        sink = ListSink()
+        audit = domoticz.AuditLog(sink, size=10, batch=3, interval=60)
+        for i in range(3):
+            audit.record('event %s' % i)
+        time.sleep(0.2)
+        self.assertEqual([[line.split(' ', 2)[2] for line in batch] for batch in sink.batches],
+                         [['event 0', 'event 1', 'event 2']])
+        audit.close()
+
+    def test_events_are_written_after_the_interval(self):
+        sink = ListSink()
+        audit = domoticz.AuditLog(sink, size=10, batch=10, interval=0.1)
+        audit.record('event')
+        time.sleep(0.3)
+        self.assertEqual(len(sink.batches), 1)
+        audit.close()
+
+    def test_oldest_events_are_dropped_and_reported(self):
+        sink = ListSink()
+        sink.writable.clear()
+        audit = domoticz.AuditLog(sink, size=2, batch=1, interval=60)
+        audit.record('blocked')
+        time.sleep(0.1)
+        for i in range(5):
+            audit.record('event %s' % i)
+        sink.writable.set()
+        audit.close()
+        self.assertEqual(audit.dropped, 3)
+        lines = [line for batch in sink.batches[1:] for line in batch]
+        self.assertEqual(lines[0], 'Dropped 3 audit events')
+        self.assertEqual([line.split(' ', 2)[2] for line in lines[1:]], ['event 3', 'event 4'])
+
+    def test_events_of_a_failed_write_are_counted(self):
+        sink = ListSink(RuntimeError('unreachable'))
+        audit = domoticz.AuditLog(sink, size=10, batch=2, interval=60)
+        audit.record('event 0')
+        audit.record('event 1')
+        audit.close()
+        self.assertEqual(audit.dropped, 2)
+
+    def test_domoticz_sink_joins_events(self):
+        messages = []
+        client = type('Client', (object,), {'add_log_message': lambda self, message: messages.append(message)})()
+        line = 'x' * (domoticz.AUDIT_MESSAGE_SIZE / 2 - 2)
+        domoticz.DomoticzLogSink(client).write([line, line, line])
+        self.assertEqual(messages, ['%s | %s' % (line, line), line])
+
+class CircuitBreakerTest(unittest.TestCase):
+    def test_opens_and_probes(self):
+        breaker = domoticz.CircuitBreaker(threshold=2, reset_timeout=0.1)
+        breaker.failed()
+        self.assertFalse(breaker.is_open())
+        breaker.failed()
+        self.assertTrue(breaker.is_open())
+        self.assertFalse(breaker.acquire_probe())
+        time.sleep(0.15)
+        self.assertTrue(breaker.acquire_probe())
+        self.assertFalse(breaker.acquire_probe())
+        breaker.succeeded()
+        self.assertFalse(breaker.is_open())
+
+    def test_failed_probe_reopens(self):
+        breaker = domoticz.CircuitBreaker(threshold=1, reset_timeout=0.1)
+        breaker.failed()
+        time.sleep(0.15)
+        self.assertTrue(breaker.acquire_probe())
+        breaker.failed()
+        self.assertTrue(breaker.is_open())
+        self.assertFalse(breaker.acquire_probe())
+
+class DiffSpecsTest(unittest.TestCase):
+    devices = [{'device': 12, 'command': False}, {'device': 14, 'level': 30}, {'device': 14, 'level': 30}]
+    timers = [{'type': 2, 'time': '7:05', 'command': 'off'}, {'type': 2, 'time': '20:30', 'days': 128}]
+
+    def device_records(self, specs):
+        # As returned by getscenedevices
+        return [{'ID': str(i), 'DevID': str(spec['device']), 'Command': spec['command'].title(),
+                 'Level': spec.get('level', 100), 'Hue': 0, 'OnDelay': 0, 'OffDelay': 0}
+                for i, spec in enumerate(specs)]
+
+    def timer_records(self, specs):
+        # As returned by scenetimers
+        return [{'idx': str(i), 'Active': 'true', 'Type': spec['type'], 'Date': '', 'Time': spec['time'],
+                 'Cmd': spec['command'], 'Level': 100, 'Days': spec.get('days', 128), 'Randomness': False}
+                for i, spec in enumerate(specs)]
+
+    def test_devices_are_idempotent(self):
+        specs = [domoticz.normalize_device(device) for device in self.devices]
+        stale, missing = domoticz.diff_specs([], specs, domoticz.SCENE_DEVICE_FIELDS)
+        self.assertEqual((stale, missing), ([], specs))
+        records = self.device_records(missing)
+        self.assertEqual(domoticz.diff_specs(records, specs, domoticz.SCENE_DEVICE_FIELDS), ([], []))
+
+    def test_timers_are_idempotent(self):
+        specs = [domoticz.normalize_timer(timer) for timer in self.timers]
+        self.assertEqual([spec['time'] for spec in specs], ['07:05', '20:30'])
+        self.assertEqual([spec['command'] for spec in specs], [1, 0])
+        records = self.timer_records(specs)
+        self.assertEqual(domoticz.diff_specs(records, specs, domoticz.SCENE_TIMER_FIELDS), ([], []))
+
+    def test_minimal_diff(self):
+        specs = [domoticz.normalize_device(device) for device in self.devices]
+        records = self.device_records(specs[:2] + [{'device': 15, 'command': 'on'}])
+        stale, missing = domoticz.diff_specs(records, specs, domoticz.SCENE_DEVICE_FIELDS)
+        self.assertEqual([record['DevID'] for record in stale], ['15'])
+        self.assertEqual(missing, [specs[2]])
+
+if __name__ == '__main__':
+    unittest.main()